@@ -0,0 +1,99 @@
+import json
+import re
+from collections import defaultdict
+
+
+FUNC_FIELDS = ["id", "name", "pos", "end", "system", "doc"]
+
+_SEPARATORS = re.compile(r"[\s,\[]*")
+
+
+def iter_json_records(path, chunk_size=1 << 20):
+    """ Streams the documents of a json array or jsonl file without loading the whole file """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+        while True:
+            pos = _SEPARATORS.match(buffer, pos).end()
+            if buffer.startswith("]", pos):
+                return
+
+            if pos < len(buffer):
+                try:
+                    record, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    # a number cut by the chunk border decodes too, only trust values followed by something
+                    if end < len(buffer) or eof:
+                        pos = end
+                        yield record
+                        continue
+
+            if eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+
+
+def _node_id(handle):
+    return handle.split("/", 1)[-1]
+
+
+class BulkGraph:
+    """
+    Caller/callee graph and function records loaded from the `--arango-nodes`/`--arango-edges` export.
+    `goto` and `callgraph` answer in the shape of the corresponding codegraph_tool queries and return
+    None when the export doesn't hold enough to answer, so the caller can fall back to a query.
+    Functions are keyed by `_key` like the edges, an `id` field differing from it is accepted as an alias.
+    """
+
+    def __init__(self):
+        self.functions = {}
+        self.aliases = {}
+        self.callees = defaultdict(list)
+        self.callers = defaultdict(list)
+
+    def add_node(self, node):
+        key = node.get("_key", node.get("id"))
+        func = {k: node[k] for k in FUNC_FIELDS if k in node}
+        func.setdefault("id", key)
+        if func["id"] != key:
+            self.aliases[func["id"]] = key
+        self.functions[key] = func
+
+    def add_edge(self, edge):
+        caller, callee = _node_id(edge["_from"]), _node_id(edge["_to"])
+        self.callees[caller].append(callee)
+        self.callers[callee].append(caller)
+
+    def _key(self, func_id):
+        return func_id if func_id in self.functions else self.aliases.get(func_id, func_id)
+
+    def goto(self, func_id):
+        func = self.functions.get(self._key(func_id))
+        if func is None or "line" not in func.get("pos", {}) or "line" not in func.get("end", {}):
+            return None
+        return [func]
+
+    def callgraph(self, func_id):
+        func_id = self._key(func_id)
+        func = self.functions.get(func_id)
+        if func is None or "pos" not in func:
+            return None
+
+        result = {k: func[k] for k in ("id", "name", "pos", "doc") if k in func}
+        result["next"] = [{"id": callee} for callee in self.callees.get(func_id, [])]
+        result["prev"] = [{"id": caller} for caller in self.callers.get(func_id, [])]
+        return [result]
+
+
+def load_bulk_graph(nodes_path, edges_path):
+    graph = BulkGraph()
+    for node in iter_json_records(nodes_path):
+        graph.add_node(node)
+    for edge in iter_json_records(edges_path):
+        graph.add_edge(edge)
+    return graph
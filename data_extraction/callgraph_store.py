@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+from collections import deque
+
+import numpy as np
+
+
+DIRECTIONS = ["next", "prev"]
+INT_FIELDS = ["start_line", "start_col", "end_line", "end_col"]
+STR_FIELDS = ["id", "name", "path"]
+
+
+class _StringTable:
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, s):
+        if s not in self.index:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index[s]
+
+    def save(self, path):
+        data = [s.encode("utf-8") for s in self.strings]
+        offsets = np.zeros(len(data) + 1, dtype=np.int64)
+        np.cumsum([len(d) for d in data], out=offsets[1:])
+        np.save(f"{path}/string_offsets.npy", offsets)
+        with open(f"{path}/strings.bin", "wb") as f:
+            f.write(b"".join(data))
+
+
+def _edge_lists(graph_json):
+    # accepts next/prev jsons ({id: [edge]}) and benchmark jsons ({id: {"calls": [edge], ...}, "blobs": {...}})
+    for func_id, edges in graph_json.items():
+        if func_id == "blobs":
+            continue
+        if isinstance(edges, dict):
+            edges = edges.get("calls", [])
+        yield func_id, edges
+
+
+def write_store(path, next_json=None, prev_json=None):
+    """
+    Writes the call graph as a directory of flat arrays: CSR offsets/targets per direction over integer
+    node ids, per-node int and string-index columns and one utf-8 string table.
+    """
+    os.makedirs(path, exist_ok=True)
+    strings = _StringTable()
+    nodes = {}
+    columns = {k: [] for k in STR_FIELDS + INT_FIELDS}
+
+    def node(func_id, edge=None):
+        if func_id not in nodes:
+            nodes[func_id] = len(nodes)
+            columns["id"].append(strings.add(func_id))
+            for k in STR_FIELDS[1:] + INT_FIELDS:
+                columns[k].append(-1)
+        i = nodes[func_id]
+        if edge is not None and columns["name"][i] == -1:
+            columns["name"][i] = strings.add(edge.get("name", ""))
+            columns["path"][i] = strings.add(edge.get("path", ""))
+            for k in INT_FIELDS:
+                columns[k][i] = edge.get(k.split("_")[0], {}).get(k.split("_")[1], -1)
+        return i
+
+    adjacency = {}
+    for direction, graph_json in zip(DIRECTIONS, (next_json, prev_json)):
+        if graph_json is None:
+            continue
+        adjacency[direction] = [
+            (node(func_id), [node(edge["id"], edge) for edge in edges])
+            for func_id, edges in _edge_lists(graph_json)
+        ]
+
+    n = len(nodes)
+    for direction, rows in adjacency.items():
+        counts = np.zeros(n, dtype=np.int64)
+        for source, targets in rows:
+            counts[source] = len(targets)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        targets = np.zeros(offsets[-1], dtype=np.int32)
+        for source, source_targets in rows:
+            targets[offsets[source]:offsets[source + 1]] = source_targets
+        np.save(f"{path}/{direction}_offsets.npy", offsets)
+        np.save(f"{path}/{direction}_targets.npy", targets)
+        # nodes that are keys of the json, an empty edge list is not the same as a missing key
+        np.save(f"{path}/{direction}_keys.npy", np.array(sorted(source for source, _ in rows), dtype=np.int32))
+
+    for k, values in columns.items():
+        np.save(f"{path}/{k}.npy", np.array(values, dtype=np.int32))
+
+    ids = np.array([strings.strings[i].encode("utf-8") for i in columns["id"]], dtype=bytes)
+    order = np.argsort(ids, kind="stable").astype(np.int32)
+    np.save(f"{path}/id_order.npy", order)
+    np.save(f"{path}/id_sorted.npy", ids[order])
+    strings.save(path)
+
+    with open(f"{path}/meta.json", "w") as f:
+        json.dump({"version": 1, "nodes": n, "directions": sorted(adjacency)}, f)
+
+
+class CallGraphStore:
+    """
+    Memory-mapped call graph written by `write_store`.
+
+    Indexing by function id gives the edges in `direction` in the shape of the next/prev jsons,
+    so the store can be passed wherever those dicts are read.
+    """
+
+    def __init__(self, path, direction="next"):
+        self.path = path
+        self.direction = direction
+        with open(f"{path}/meta.json", "r") as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(f"{path}/{name}.npy", mmap_mode="r")
+
+        self.columns = {k: load(k) for k in STR_FIELDS + INT_FIELDS}
+        self.csr = {d: (load(f"{d}_offsets"), load(f"{d}_targets")) for d in self.meta["directions"]}
+        self.keys = {d: load(f"{d}_keys") for d in self.meta["directions"]}
+        self.id_order = load("id_order")
+        self.id_sorted = load("id_sorted")
+        self.string_offsets = load("string_offsets")
+        self.strings = np.memmap(f"{path}/strings.bin", dtype=np.uint8, mode="r") \
+            if self.string_offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def string(self, i):
+        if i < 0:
+            return ""
+        return bytes(self.strings[self.string_offsets[i]:self.string_offsets[i + 1]]).decode("utf-8")
+
+    def func_id(self, node):
+        return self.string(self.columns["id"][node])
+
+    def node(self, func_id):
+        """ Integer node id of a function id, found by binary search over the sorted ids """
+        key = func_id.encode("utf-8")
+        i = np.searchsorted(self.id_sorted, key)
+        if i < len(self.id_sorted) and self.id_sorted[i] == key:
+            return int(self.id_order[i])
+        return None
+
+    def _targets(self, node, direction):
+        offsets, targets = self.csr[direction]
+        return targets[offsets[node]:offsets[node + 1]]
+
+    def _neighbors(self, func_id, direction):
+        node = self.node(func_id)
+        if node is None:
+            return []
+        return [self.func_id(t) for t in self._targets(node, direction)]
+
+    def callees(self, func_id):
+        return self._neighbors(func_id, "next")
+
+    def callers(self, func_id):
+        return self._neighbors(func_id, "prev")
+
+    def neighborhood(self, func_id, k=1, direction="next"):
+        """ Function ids reachable in at most `k` hops, `direction` is "next", "prev" or "both" """
+        start = self.node(func_id)
+        if start is None:
+            return set()
+
+        directions = DIRECTIONS if direction == "both" else [direction]
+        seen = {start: 0}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            if seen[node] == k:
+                continue
+            for d in directions:
+                for t in self._targets(node, d):
+                    t = int(t)
+                    if t not in seen:
+                        seen[t] = seen[node] + 1
+                        queue.append(t)
+
+        del seen[start]
+        return {self.func_id(node) for node in seen}
+
+    def record(self, node):
+        c = self.columns
+
+        def position(prefix):
+            line, col = int(c[f"{prefix}_line"][node]), int(c[f"{prefix}_col"][node])
+            return {"line": line, "col": col} if line >= 0 else {}
+
+        return {
+            "id": self.func_id(node),
+            "name": self.string(c["name"][node]),
+            "path": self.string(c["path"][node]),
+            "start": position("start"),
+            "end": position("end"),
+        }
+
+    def edges(self, func_id, direction=None):
+        node = self.node(func_id)
+        if node is None:
+            return []
+        return [self.record(int(t)) for t in self._targets(node, direction or self.direction)]
+
+    def __contains__(self, func_id):
+        node = self.node(func_id)
+        if node is None:
+            return False
+        keys = self.keys[self.direction]
+        i = np.searchsorted(keys, node)
+        return bool(i < len(keys) and keys[i] == node)
+
+    def __getitem__(self, func_id):
+        if func_id not in self:
+            raise KeyError(func_id)
+        return self.edges(func_id)
+
+    def get(self, func_id, default=None):
+        return self[func_id] if func_id in self else default
+
+
+def read_call_graph(path, direction="next"):
+    """
+    Opens `path` as a `CallGraphStore` if it is one or if the store converted from it lies next to it
+    (`{name}.graph` of `{name}.json`), otherwise reads it as a json
+    """
+    for store_path in (path, os.path.splitext(path)[0] + ".graph"):
+        if os.path.isfile(f"{store_path}/meta.json"):
+            return CallGraphStore(store_path, direction)
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--next-path', help="next json (db_stat.py output) or benchmark json")
+    parser.add_argument('--prev-path', help="prev json (db_stat.py -prev.json output)")
+    parser.add_argument('--out-path')
+
+    args = parser.parse_args()
+
+    graphs = []
+    for path in (args.next_path, args.prev_path):
+        graph_json = None
+        if path:
+            with open(path, "r") as f:
+                graph_json = json.load(f)
+        graphs.append(graph_json)
+
+    write_store(args.out_path, *graphs)
+
+
+if __name__ == "__main__":
+    main()
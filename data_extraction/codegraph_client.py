@@ -0,0 +1,301 @@
+import atexit
+import json
+import os
+import queue
+import selectors
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from query_metrics import METRICS
+
+TOOL_PATH = "./codegraph_tool"
+PROBE_TIMEOUT = 10  # seconds to wait for the first answer before checking whether the tool waits for EOF
+GOTO_TIMEOUT = 60  # goto queries are quick, one that doesn't come back in time is not going to
+
+_SESSIONS = {}
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class _ToolProcess:
+    """ A single `codegraph_tool query` process answering json queries sent over stdin, one answer per line """
+
+    def __init__(self, args):
+        self.args = args
+        self.proc = None
+        self.buffer = ""
+        self.answered = 0
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.close()
+        self.proc = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        self.buffer = ""
+        self.answered = 0
+
+    def close(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        for stream in (self.proc.stdin, self.proc.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        self.proc = None
+
+    def send(self, query):
+        if not self.alive():
+            self.start()
+        self.proc.stdin.write((json.dumps(query) + "\n").encode("utf-8"))
+        self.proc.stdin.flush()
+
+    def close_stdin(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+    def _pop_value(self, eof=False):
+        # the line is consumed even if it isn't json, so the next answer is read in sync
+        while True:
+            line, newline, rest = self.buffer.partition("\n")
+            if not newline and not eof:
+                return False, None
+            self.buffer = rest
+            if line.strip():
+                return True, json.loads(line)
+            if not newline:
+                return False, None
+
+    def receive(self, deadline):
+        """
+        Reads the next answer line printed by the tool, None if the tool exited without answering.
+        Raises ValueError if the line is not json.
+        """
+        found, value = self._pop_value()
+        if found:
+            return value
+
+        fd = self.proc.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0 or not selector.select(remaining):
+                    raise QueryTimeout()
+
+                chunk = os.read(fd, 1 << 16)
+                if not chunk:
+                    return self._pop_value(eof=True)[1]
+
+                self.buffer += chunk.decode("utf-8", errors="replace")
+                found, value = self._pop_value()
+                if found:
+                    return value
+
+
+class QuerySession:
+    """
+    Keeps `processes` codegraph_tool instances open and sends them queries over stdin/stdout
+    instead of spawning a shell and reopening the index for every query.
+
+    If the tool turns out to answer only once per process (it waits for EOF or exits after the
+    first answer), the session falls back to running one process per query.
+
+    Processes are started when first needed. Single queries reuse the most recently idle one, `query_many`
+    splits its queries between all of them and pipelines the shares concurrently.
+    """
+
+    def __init__(self, db_path, tool_path=TOOL_PATH, processes=1):
+        self.args = shlex.split(tool_path) + ["query", "--index-database-path", db_path]
+        self.persistent = True
+        self.confirmed = False
+        # last in, first out: sequential queries keep going to the one process already started
+        self.idle = queue.LifoQueue()
+        self.workers = [_ToolProcess(self.args) for _ in range(max(1, processes))]
+        for w in self.workers:
+            self.idle.put(w)
+        self.executor = ThreadPoolExecutor(len(self.workers)) if len(self.workers) > 1 else None
+
+    def query(self, query, timeout=None):
+        kind = query.get("query", "")
+        started = time.monotonic()
+        try:
+            if not self.persistent:
+                result = self._query_once(query, timeout)
+            else:
+                worker = self.idle.get()
+                try:
+                    result = self._query_persistent(worker, query, timeout)
+                finally:
+                    self.idle.put(worker)
+        except QueryTimeout:
+            METRICS.timeout(kind)
+            raise
+        except ValueError:
+            METRICS.decode_error(kind)
+            raise
+        except Exception:
+            METRICS.error(kind)
+            raise
+
+        METRICS.record(kind, time.monotonic() - started)
+        return result
+
+    def query_many(self, queries, timeout=None, batch_size=256):
+        """ Pipelines the queries through one process per batch, answers are returned in order """
+        if self.executor is not None and self.persistent and self.confirmed and len(queries) > 1:
+            batch_size = min(batch_size, -(-len(queries) // len(self.workers)))
+            batches = [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+            return [r for batch in self.executor.map(lambda b: self._query_batch(b, timeout), batches) for r in batch]
+
+        results = []
+        for start in range(0, len(queries), batch_size):
+            results.extend(self._query_batch(queries[start:start + batch_size], timeout))
+        return results
+
+    def _query_batch(self, queries, timeout):
+        if not self.confirmed and self.persistent and queries:
+            # don't pipeline into a tool that may be waiting for EOF
+            return [self.query(queries[0], timeout)] + self._query_batch(queries[1:], timeout)
+        if not self.persistent or len(queries) <= 1:
+            return [self.query(q, timeout) for q in queries]
+
+        results = []
+        worker = self.idle.get()
+        try:
+            try:
+                # a batch is small enough to fit the pipe buffer, so writing it all first can't deadlock
+                for q in queries:
+                    worker.send(q)
+                last = time.monotonic()
+                for q in queries:
+                    try:
+                        result = worker.receive(last + timeout if timeout is not None else None)
+                    except ValueError:
+                        # the bad line is consumed, the following answers are still in order
+                        METRICS.decode_error(q.get("query", ""))
+                        worker.answered += 1
+                        results.append(None)
+                        last = time.monotonic()
+                        continue
+                    if result is None:
+                        break
+                    # pipelined answers are timed from the previous one
+                    METRICS.record(q.get("query", ""), time.monotonic() - last)
+                    last = time.monotonic()
+                    worker.answered += 1
+                    results.append(result)
+            except BrokenPipeError:
+                pass
+            except QueryTimeout:
+                METRICS.timeout(queries[len(results)].get("query", ""))
+
+            if len(results) < len(queries):
+                if worker.answered == 1:
+                    self._switch_to_one_shot()
+                worker.close()
+        finally:
+            self.idle.put(worker)
+
+        return results + [self.query(q, timeout) for q in queries[len(results):]]
+
+    def _query_persistent(self, worker, query, timeout):
+        wait = timeout
+        if not self.confirmed:
+            wait = PROBE_TIMEOUT if timeout is None else min(timeout, PROBE_TIMEOUT)
+        started = time.monotonic()
+
+        try:
+            worker.send(query)
+            result = worker.receive(started + wait if wait is not None else None)
+        except BrokenPipeError:
+            result = None
+        except QueryTimeout:
+            if worker.answered or self.confirmed:
+                worker.close()
+                raise
+            # a tool that only answers on EOF looks exactly like a slow first query, tell them apart
+            worker.close_stdin()
+            try:
+                result = worker.receive(time.monotonic() + 1)
+            except QueryTimeout:
+                result = None
+            worker.close()
+            if result is not None:
+                self._switch_to_one_shot()
+                return result
+            if timeout is not None and time.monotonic() - started >= timeout:
+                raise
+            return self._query_once(query, timeout - (time.monotonic() - started) if timeout is not None else None)
+
+        if result is None:
+            # the process is gone: either it answers a single query per run or it crashed on this one
+            if worker.answered == 1:
+                self._switch_to_one_shot()
+            worker.close()
+            return self._query_once(query, timeout)
+
+        worker.answered += 1
+        self.confirmed = True
+        return result
+
+    def _switch_to_one_shot(self):
+        if self.persistent:
+            print("codegraph_tool does not keep the query session open, running one process per query.")
+        self.persistent = False
+
+    def _query_once(self, query, timeout):
+        try:
+            out = subprocess.run(self.args, input=json.dumps(query), capture_output=True,
+                                 encoding="utf-8", timeout=timeout).stdout
+        except subprocess.TimeoutExpired:
+            raise QueryTimeout()
+        return json.loads(out) if out.strip() else None
+
+    def goto(self, func_id, timeout=GOTO_TIMEOUT):
+        return self.query({"query": "goto", "id": func_id}, timeout)
+
+    def goto_many(self, func_ids, timeout=GOTO_TIMEOUT):
+        return self.query_many([{"query": "goto", "id": func_id} for func_id in func_ids], timeout)
+
+    def callgraph(self, func_id, path="", timeout=None):
+        return self.query({"query": "callgraph", "function": func_id, "path": path, "macros": False}, timeout)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        for w in self.workers:
+            w.close()
+
+
+def open_session(db_path, tool_path=TOOL_PATH, processes=1):
+    if db_path in _SESSIONS:
+        _SESSIONS[db_path].close()
+    _SESSIONS[db_path] = QuerySession(db_path, tool_path, processes)
+    return _SESSIONS[db_path]
+
+
+def get_session(db_path):
+    if db_path not in _SESSIONS:
+        _SESSIONS[db_path] = QuerySession(db_path)
+    return _SESSIONS[db_path]
+
+
+def close_sessions():
+    for session in _SESSIONS.values():
+        session.close()
+    _SESSIONS.clear()
+
+
+atexit.register(close_sessions)
@@ -1,59 +1,262 @@
+import argparse
 import json
 import os
-import sys
+from collections import defaultdict
 from datetime import datetime
+from functools import partial
 from glob import glob
+from multiprocessing import Pool
 
 import git
+import pandas as pd
 from tqdm import tqdm
 
+from codegraph_client import TOOL_PATH, open_session
+from line_ages import LineAgeWriter, LineAges, day_number, is_line_ages
 
-def parse_subset(project_path, partition_n, partition):
-    # json: for each cpp file, for each line: date
 
-    repo = git.Repo(project_path)
-    result = {}
+_WORKER = {"repo": None, "project_path": None}
+
+
+def _format_date(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%d.%m.%Y')
+
+
+def _init_worker(project_path):
+    _WORKER["repo"] = git.Repo(project_path)
+    _WORKER["project_path"] = project_path
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _iter_tasks(project_path, task, items, workers):
+    """
+    Runs `task` for every (file relative to the repository, arg) in `items` and yields the results as they
+    finish. Files are handed out one by one largest first, so a few huge files don't end up in one worker.
+    """
+    items = sorted(items, key=lambda item: _file_size(os.path.join(project_path, item[0])), reverse=True)
+    if workers > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(project_path,)) as pool:
+            yield from tqdm(pool.imap_unordered(task, items), total=len(items))
+    else:
+        _init_worker(project_path)
+        yield from tqdm(map(task, items), total=len(items))
+
+
+def _write_entries(output_path, entries):
+    """ Writes {key: value} entry by entry instead of building the dict """
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write("{")
+        for i, (key, value) in enumerate(entries):
+            f.write((", " if i else "") + f"{json.dumps(key)}: {json.dumps(value)}")
+        f.write("}")
 
-    paths = [
+
+def _blame_lines(item, days=False):
+    file, path = item
+    try:
+        lines = {}
+        for b in _WORKER["repo"].blame_incremental("HEAD", file):
+            d = day_number(b.commit.committed_date) if days else _format_date(b.commit.committed_date)
+            for i in b.linenos:
+                lines[i] = d
+        return path, {k: v for k, v in sorted(lines.items())}
+    except Exception:
+        print(path)
+        return path, None
+
+
+def source_paths(project_path):
+    return [
         p for p in
         glob(project_path + "/**/*.cpp", recursive=True) +
         glob(project_path + "/**/*.c", recursive=True) +
         glob(project_path + "/**/*.h", recursive=True)
     ]
 
+
+def changed_files(project_path, old_commit):
+    """ Files changed, added or deleted between `old_commit` and HEAD, relative to the repository """
+    diff = git.Repo(project_path).git.diff("--name-only", "-z", old_commit, "HEAD")
+    return {file for file in diff.split("\0") if file}
+
+
+def iter_line_dates(project_path, paths, workers=1, days=False, previous=None, changed=()):
+    """
+    Yields (path, {line: date}) for every file of `paths` blamed successfully, dates as day numbers if `days`.
+    Files in `previous` output and not in `changed` are carried over without blaming.
+    """
+    items = []
+    for p in paths:
+        if not os.path.isfile(p):
+            continue
+        file = p.replace(project_path, "", 1)[1:]
+        if previous is not None and file not in changed and p in previous:
+            yield p, previous[p]
+        else:
+            items.append((file, p))
+
+    for path, lines in _iter_tasks(project_path, partial(_blame_lines, days=days), items, workers):
+        if lines is not None:
+            yield path, lines
+
+
+def parse_subset(project_path, partition_n, partition, workers=1):
+    # json: for each cpp file, for each line: date
+
+    paths = source_paths(project_path)
     n = len(paths) // partition_n + 1
     paths = paths[partition * n:(partition + 1) * n]
-    paths = [p for p in paths if os.path.isfile(p)]
 
-    for file in tqdm(paths, total=len(paths)):
-        try:
-            lines = {}
-            blame = repo.blame_incremental("HEAD", file.replace(project_path, "", 1)[1:])
+    return dict(iter_line_dates(project_path, paths, workers))
+
 
-            for b in blame:
-                d = datetime.fromtimestamp(b.commit.committed_date).strftime('%d.%m.%Y')
-                for i in b.linenos:
-                    lines[i] = d
+def _count_lines(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    return data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
 
-            lines = {k: v for k, v in sorted(lines.items())}
-            result[file] = lines
-        except Exception:
-            print(file)
 
+def _merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def function_ranges(table, project_path):
+    """ {file relative to the repository: [(func id, first line, last line)]} for the rows of a db_stat table """
+    ranges = defaultdict(list)
+    id_column = table.columns[0]
+    for func_id, path, pos, code_length in zip(table[id_column], table["path"], table["pos"], table["code_length"]):
+        if not isinstance(path, str) or code_length <= 0:
+            continue
+        file = os.path.relpath(path.replace("\\", "/"), project_path)
+        ranges[file].append((func_id, int(pos), int(pos + code_length - 1)))
+    return ranges
+
+
+def blame_functions(repo, project_path, file, functions):
+    """ Blames only the lines of `functions` in `file` and returns the last commit date of every function """
+    n_lines = _count_lines(os.path.join(project_path, file))
+    functions = [(func_id, start, min(end, n_lines)) for func_id, start, end in functions if start <= n_lines]
+    if not functions:
+        return {}
+
+    ranges = _merge_ranges([(start, end) for _, start, end in functions])
+    lines = {}
+    for b in repo.blame_incremental("HEAD", file, L=[f"{start},{end}" for start, end in ranges]):
+        for i in b.linenos:
+            lines[i] = b.commit.committed_date
+
+    result = {}
+    for func_id, start, end in functions:
+        dates = [lines[i] for i in range(start, end + 1) if i in lines]
+        if dates:
+            result[func_id] = _format_date(max(dates))
     return result
 
 
+def _blame_functions(item):
+    file, functions = item
+    try:
+        return blame_functions(_WORKER["repo"], _WORKER["project_path"], file, functions)
+    except Exception:
+        print(file)
+        return {}
+
+
+def iter_function_dates(project_path, table, workers=1, previous=None, changed=()):
+    """
+    Yields (func id, last commit date) for the functions of a db_stat table, blaming only their lines.
+    Functions in `previous` output are carried over unless their file is in `changed`.
+    """
+    ranges = function_ranges(table, project_path)
+    if previous is not None:
+        for file in list(ranges):
+            if file in changed:
+                continue
+            yield from ((func[0], previous[func[0]]) for func in ranges[file] if func[0] in previous)
+            ranges[file] = [func for func in ranges[file] if func[0] not in previous]
+            if not ranges[file]:
+                del ranges[file]
+
+    for dates in _iter_tasks(project_path, _blame_functions, ranges.items(), workers):
+        yield from dates.items()
+
+
+def parse_functions(project_path, table, workers=1):
+    # json: for each function of the table: date of the last commit touching its lines
+    return dict(iter_function_dates(project_path, table, workers))
+
+
 def main():
-    project_path = sys.argv[1]
-    output_path = sys.argv[2]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('project_path')
+    parser.add_argument('output_path', help="json, or the binary line-age format (line_ages.py) for a `.ages` path")
+    parser.add_argument('partition_n', nargs="?", type=int)
+    parser.add_argument('partition', nargs="?", type=int)
+    parser.add_argument('--table-path', help="db_stat.py table, blame only the lines of its functions and "
+                                             "write {function id: last commit date}")
+    parser.add_argument('--db-path', help="codegraph_tool database to look up positions the table lacks")
+    parser.add_argument('--codegraph-tool', default=TOOL_PATH)
+    parser.add_argument('--workers', type=int, default=1, help="blame files in a pool of processes")
+    parser.add_argument('--previous-path', help="output of an earlier run in the same mode and format, "
+                                                "only files changed since --previous-commit are blamed again")
+    parser.add_argument('--previous-commit', help="commit the previous output was extracted at "
+                                                  "(has to be fetched in a shallow clone)")
 
-    if len(sys.argv) == 3:
-        result = parse_subset(project_path, 1, 0)
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(result, f)
+    args = parser.parse_args()
+    project_path = args.project_path
+    output_path = args.output_path
+
+    ages_output = args.table_path is None and args.partition_n is None and output_path.endswith(".ages")
+    if args.previous_path and not args.previous_commit:
+        parser.error("--previous-path needs --previous-commit, the files changed since are blamed again")
+    if args.previous_path and args.partition_n is not None:
+        parser.error("--previous-path can't be combined with partitions")
+    if args.previous_path and is_line_ages(args.previous_path) != ages_output:
+        parser.error("--previous-path has to be in the format of the output (json or .ages)")
+
+    previous, changed = None, ()
+    if args.previous_path:
+        changed = changed_files(project_path, args.previous_commit)
+        if is_line_ages(args.previous_path):
+            previous = LineAges(args.previous_path)
+        else:
+            with open(args.previous_path, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+
+    if args.table_path:
+        table = pd.read_csv(args.table_path)
+        if "pos" not in table.columns:
+            from merge_commits import add_pos
+
+            open_session(args.db_path, args.codegraph_tool)
+            add_pos(table, args.db_path)
+
+        _write_entries(output_path, iter_function_dates(project_path, table, args.workers, previous, changed))
+
+    elif ages_output:
+        with LineAgeWriter(output_path) as writer:
+            for path, lines in iter_line_dates(project_path, source_paths(project_path), args.workers, True,
+                                               previous, changed):
+                writer.write(path, lines)
+
+    elif args.partition_n is None:
+        _write_entries(output_path, iter_line_dates(project_path, source_paths(project_path), args.workers,
+                                                    previous=previous, changed=changed))
 
-    elif len(sys.argv) == 4:
-        partition_n = int(sys.argv[3])
+    elif args.partition is None:
+        partition_n = args.partition_n
         result = {}
         for partition in range(partition_n):
             with open(f"{partition}_{output_path}", "r", encoding="utf-8") as f:
@@ -62,10 +265,10 @@ def main():
         with open(output_path, "w", encoding="utf-8") as f:
             json.dump(result, f)
 
-    elif len(sys.argv) == 5:
-        partition_n = int(sys.argv[3])
-        partition = int(sys.argv[4])
-        result = parse_subset(project_path, partition_n, partition)
+    else:
+        partition_n = args.partition_n
+        partition = args.partition
+        result = parse_subset(project_path, partition_n, partition, args.workers)
 
         with open(f"{partition}_{output_path}", "w", encoding="utf-8") as f:
             json.dump(result, f)
@@ -0,0 +1,195 @@
+import gzip
+import json
+import re
+
+import numpy as np
+import pandas as pd
+
+
+FORMATS = ["gcov", "llvm-cov"]
+
+
+def _open(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+_NON_WS = re.compile(rb"[^ \t\r\n]")
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"')
+_SCALAR = re.compile(rb"[-+0-9.eE]+|true|false|null")
+_BRACKETS = re.compile(rb"[\[\]{}]")
+_DEPTH = np.zeros(256, dtype=np.int64)
+_DEPTH[list(b"[{")] = 1
+_DEPTH[list(b"]}")] = -1
+
+
+class _JsonStream:
+    """
+    Reads a json file a chunk at a time, just enough to walk down to the values under an ijson-style prefix.
+    Skipped values are scanned for brackets outside of strings and never decoded.
+    """
+
+    def __init__(self, f, chunk_size=1 << 22):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.pos = 0
+        self.mark = None
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            return False
+        keep = self.pos if self.mark is None else self.mark
+        self.buffer = self.buffer[keep:] + chunk
+        self.pos -= keep
+        if self.mark is not None:
+            self.mark = 0
+        return True
+
+    def peek(self):
+        while True:
+            match = _NON_WS.search(self.buffer, self.pos)
+            if match:
+                self.pos = match.start()
+                return self.buffer[self.pos:self.pos + 1]
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return b""
+
+    def take(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char.decode()} in json at byte {self.pos} of the buffer")
+        self.pos += 1
+
+    def _match(self, pattern):
+        while True:
+            match = pattern.match(self.buffer, self.pos)
+            # a match reaching the end of the buffer may go on in the next chunk
+            if match and match.end() < len(self.buffer):
+                break
+            if not self._fill():
+                break
+        if not match:
+            raise ValueError(f"Invalid json at byte {self.pos} of the buffer")
+        self.pos = match.end()
+        return match.group()
+
+    def skip(self):
+        char = self.peek()
+        if char == b'"':
+            self._match(_STRING)
+        elif char in (b"[", b"{"):
+            self._skip_container()
+        elif char:
+            self._match(_SCALAR)
+        else:
+            raise ValueError("Unexpected end of json")
+
+    def _skip_container(self):
+        depth = 0
+        while True:
+            quote = self.buffer.find(b'"', self.pos)
+            end = quote if quote >= 0 else len(self.buffer)
+            if end - self.pos > 4096:
+                # long runs without strings are the coverage arrays, count their brackets in bulk
+                levels = depth + np.cumsum(_DEPTH[np.frombuffer(self.buffer, np.uint8, end - self.pos, self.pos)])
+                closed = np.flatnonzero(levels == 0)
+                if len(closed):
+                    self.pos += int(closed[0]) + 1
+                    return
+                depth = int(levels[-1])
+            else:
+                for bracket in _BRACKETS.finditer(self.buffer, self.pos, end):
+                    depth += 1 if self.buffer[bracket.start()] in b"[{" else -1
+                    if depth == 0:
+                        self.pos = bracket.end()
+                        return
+            self.pos = end
+            if quote >= 0:
+                self._match(_STRING)
+            elif not self._fill():
+                raise ValueError("Unexpected end of json")
+
+    def value(self):
+        self.peek()
+        self.mark = self.pos
+        self.skip()
+        text = self.buffer[self.mark:self.pos]
+        self.mark = None
+        return json.loads(text)
+
+    def items(self, keys):
+        """ Values under the path `keys`, "item" stands for every element of an array """
+        if not keys:
+            yield self.value()
+            return
+
+        key, rest = keys[0], keys[1:]
+        opening, closing = (b"[", b"]") if key == "item" else (b"{", b"}")
+        if self.peek() != opening:
+            self.skip()
+            return
+        self.take(opening)
+        while self.peek() != closing:
+            if key == "item":
+                yield from self.items(rest)
+            else:
+                name = json.loads(self._match(_STRING))
+                self.take(b":")
+                if name == key:
+                    yield from self.items(rest)
+                else:
+                    self.skip()
+            if self.peek() == b",":
+                self.pos += 1
+        self.take(closing)
+
+
+def _iter_items(path, prefix):
+    """ Streams the values under an ijson `prefix`, with a small built-in reader if ijson isn't installed """
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+
+    with _open(path) as f:
+        if ijson is not None:
+            yield from ijson.items(f, prefix, use_float=True)
+        else:
+            yield from _JsonStream(f).items(prefix.split("."))
+
+
+def iter_gcov_records(path):
+    """ (file, function, hits) of a `gcov --json-format` output, demangled names if gcov was run with -m """
+    for file in _iter_items(path, "files.item"):
+        for func in file.get("functions", []):
+            yield file["file"], func.get("demangled_name", func["name"]), func["execution_count"]
+
+
+def iter_llvm_cov_records(path):
+    """ (file, function, hits) of an `llvm-cov export` output, demangled names with -Xdemangler=c++filt """
+    for func in _iter_items(path, "data.item.functions.item"):
+        if func.get("filenames"):
+            yield func["filenames"][0], func["name"], func["count"]
+
+
+RECORDS = {
+    "gcov": iter_gcov_records,
+    "llvm-cov": iter_llvm_cov_records,
+}
+
+
+def iter_coverage_chunks(paths, coverage_format, chunk_size=1000000):
+    """
+    Coverage exports as frames of at most `chunk_size` (file, fname, hits) rows, the shape of the
+    test coverage tsv chunks `merge_test_cov.get_cov_hits` aggregates.
+    """
+    rows = []
+    for path in paths:
+        for row in RECORDS[coverage_format](path):
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield pd.DataFrame(rows, columns=["file", "fname", "hits"])
+                rows = []
+    if rows:
+        yield pd.DataFrame(rows, columns=["file", "fname", "hits"])
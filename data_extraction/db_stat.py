@@ -1,11 +1,17 @@
 import argparse
 import json
 import os
-import subprocess
+import time
+from functools import partial
+from multiprocessing import Pool
 
-import pandas as pd
 from tqdm import tqdm
 
+from arango_graph import load_bulk_graph
+from codegraph_client import QueryTimeout, TOOL_PATH, get_session, open_session
+from query_metrics import METRICS, LatencyHistogram
+from table_writer import DatasetWriter
+
 
 STATS = {
     "system": 0,
@@ -15,77 +21,129 @@ STATS = {
     "other": 0,
 }
 
+CACHE_STATS = {
+    "hits": 0,
+    "misses": 0,
+}
+
+TIMED_OUT = "timeout"
+
+
+class TimeoutPolicy:
+    """
+    Deadline of callgraph queries. Until `warmup` answers are seen it is `initial`, then `factor` times
+    the observed p95 latency clamped to [minimum, initial], so the slow tail times out early and is
+    retried later in a separate pass with a `fixed` long deadline.
+    """
+
+    def __init__(self, initial=10, minimum=1, factor=4, warmup=50):
+        self.initial = initial
+        self.minimum = minimum
+        self.factor = factor
+        self.warmup = warmup
+        self.fixed = None
+        self.latency = LatencyHistogram()
 
-def get_callgraph(func_id, w_path, path="", i=""):
-    json_query = {"query": "callgraph",
-                  "function": func_id,
-                  "path": path,
-                  "macros": False}
+    def deadline(self):
+        if self.fixed is not None:
+            return self.fixed
+        if self.latency.count < self.warmup:
+            return self.initial
+        return min(self.initial, max(self.minimum, self.factor * self.latency.percentile(95)))
 
-    with open(f"tmp{i}.json", "w") as outfile:
-        json.dump(json_query, outfile)
+    def observe(self, seconds):
+        self.latency.add(seconds)
 
-    command = f"./codegraph_tool query --index-database-path {w_path} --pretty-print  < tmp{i}.json"
-    out = ""
 
+TIMEOUT_POLICY = TimeoutPolicy()
+
+
+def get_callgraph(func_id, w_path, path="", timeout=None):
+    started = time.monotonic()
     try:
-        out = subprocess.run(command, shell=True, capture_output=True, encoding='utf-8', timeout=10).stdout
-    except subprocess.TimeoutExpired:
-        print("Timeout reached.")
-        return json.loads("{}")
+        out = get_session(w_path).callgraph(func_id, path, timeout=timeout or TIMEOUT_POLICY.deadline())
+    except QueryTimeout:
+        return None
     except Exception as exp:
         print(f"Unexpected exception: {exp}")
+        return {}
 
-    if out:
-        return json.loads(out)
-
+    TIMEOUT_POLICY.observe(time.monotonic() - started)
     # print("Return null info about func")
-    return json.loads("{}")
-
+    return out or {}
 
-def get_func_info(func_id, w_path, i=""):
-    with open(f"query{i}.json", "w") as f:
-        json.dump({"query": "goto", "id": func_id}, f)
 
-    command = f"./codegraph_tool query --index-database-path {w_path} --pretty-print  < query{i}.json > query_answer{i}.json"
-    subprocess.run(command, shell=True, capture_output=True, encoding='utf-8')
+def get_func_info(func_id, w_path):
+    json_dump = {}
+    try:
+        json_dump = get_session(w_path).goto(func_id) or {}
+    except Exception as exp:
+        print(f"Unexpected exception in get_func_info: {exp}")
+    return json_dump
 
-    with open(f"query_answer{i}.json", "r") as f:
-        file = "\n".join(f.readlines())
 
-    json_dump = json.loads("{}")
+def get_func_infos(func_ids, w_path):
     try:
-        with open(f"query_answer{i}.json", "r") as f:
-            json_dump = json.load(f)
+        return [info or {} for info in get_session(w_path).goto_many(func_ids)]
     except Exception as exp:
-        print(f"Unexpected exception in get_func_info: {exp}\n{file}")
-    return json_dump
+        print(f"Unexpected exception in get_func_infos: {exp}")
+        return [get_func_info(func_id, w_path) for func_id in func_ids]
+
+
+def get_edge(func_id, func_info):
+    func = (func_info or [dict()])[0]
+
+    name = func.get("name", "")
+    path = func.get("pos", {}).get("path", "")
+    system = func.get("system", False)
+    if "pos" in func and "line" in func["pos"] and "col" in func["pos"]:
+        func["start"] = {"line": func["pos"]["line"], "col": func["pos"]["col"]}
+
+    return [func_id, name, path, system, func.get("start", {}), func.get("end", {})]
+
+
+class FuncInfoCache:
+    """ Resolves every caller/callee id once per run, new ids are fetched in one batch of goto queries """
+
+    def __init__(self, db_path, graph=None):
+        self.db_path = db_path
+        self.graph = graph
+        self.edges = {}
+
+    def resolve(self, func_ids):
+        missing = [func_id for func_id in dict.fromkeys(func_ids) if func_id not in self.edges]
+        CACHE_STATS["hits"] += len(func_ids) - len(missing)
+        CACHE_STATS["misses"] += len(missing)
 
+        if self.graph is not None:
+            for func_id in missing:
+                func_info = self.graph.goto(func_id)
+                if func_info is not None:
+                    self.edges[func_id] = get_edge(func_id, func_info)
+            missing = [func_id for func_id in missing if func_id not in self.edges]
 
-def process_callgraph(main_func_info, db_path, i=""):
+        for func_id, func_info in zip(missing, get_func_infos(missing, self.db_path)):
+            self.edges[func_id] = get_edge(func_id, func_info)
+
+        return [list(self.edges[func_id]) for func_id in func_ids]
+
+
+def process_callgraph(main_func_info, db_path, cache=None):
     if set(main_func_info).difference(['id', 'name', 'pos', 'prev', 'next', 'doc']):
         print(main_func_info.keys())
 
+    cache = cache or FuncInfoCache(db_path)
     edge_dirs = ['prev', 'next']
     func_num = {k: 0 for k in edge_dirs}
     funcs_id = {k: [] for k in edge_dirs}
-    for direction in edge_dirs:
-        if direction not in main_func_info:
-            continue
-
-        func_num[direction] = len(main_func_info[direction])
-        for func_id in main_func_info[direction]:
-            func = get_func_info(func_id["id"], db_path, i) or [dict()]
-            func = func[0]
 
-            name = func.get("name", "")
-            path = func.get("pos", {}).get("path", "")
-            system = func.get("system", False)
-            if "pos" in func and "line" in func["pos"] and "col" in func["pos"]:
-                func["start"] = {"line": func["pos"]["line"], "col": func["pos"]["col"]}
-
-            funcs_id[direction].append([func_id["id"], name, path, system, func.get("start", {}), func.get("end", {})])
+    ids = {k: [func_id["id"] for func_id in main_func_info.get(k, [])] for k in edge_dirs}
+    edges = cache.resolve(ids['prev'] + ids['next'])
+    for direction in edge_dirs:
+        func_num[direction] = len(ids[direction])
+        funcs_id[direction], edges = edges[:func_num[direction]], edges[func_num[direction]:]
 
+        for _, _, path, system, _, _ in funcs_id[direction]:
             if system:
                 STATS["system"] += 1
             if "/home" in path:
@@ -150,111 +208,277 @@ def parse_groups(data, length):
     data["code_length"] = length
 
 
-def get_dataset(functions, project_path, project_root, db_path, i=""):
+def process_function(func, project_path, project_root, db_path, cache):
+    graph = cache.graph
+    func_info = graph.goto(func['_key']) if graph is not None else None
+    if func_info is None:
+        func_info = get_func_info(func['_key'], db_path)
+    is_valid = False
+    length = 0
+
+    if len(func_info) != 0:
+        func_info = func_info[0]
+        if project_root in func_info["pos"]["path"]:
+            length = func_info["end"]["line"] - func_info["pos"]["line"]
+            if length != 0:
+                is_valid = True
+
+    if is_valid:
+        func_callgraph = graph.callgraph(func_info["id"]) if graph is not None else None
+        if func_callgraph is None:
+            func_callgraph = get_callgraph(func_info["id"], db_path, func_info["pos"]["path"])
+        if func_callgraph is None:
+            return TIMED_OUT
+        if func_callgraph:
+            data = process_callgraph(func_callgraph[0], db_path, cache)
+            if data is not None:
+                parse_groups(data, length)
+                data["pos"] = func_info["pos"]["line"]
+                data["end"] = func_info["end"]["line"]
+                data["path"] = data["path"].replace(project_path, "", 1)[1:]
+                return func_info["id"], data
+    return None
+
+
+# the bulk graph reaches the pool workers through fork instead of being pickled for each of them
+_WORKER = {"graph": None}
+
+
+def _reset_counters():
+    for counters in (STATS, CACHE_STATS):
+        for k in counters:
+            counters[k] = 0
+    METRICS.reset()
+
+
+def _init_worker(db_path, tool_path, query_processes, callgraph_timeout):
+    open_session(db_path, tool_path, query_processes)
+    _WORKER["cache"] = FuncInfoCache(db_path, _WORKER["graph"])
+    TIMEOUT_POLICY.fixed = callgraph_timeout
+    # forked workers start with the parent's counters, only their own increments are sent back
+    _reset_counters()
+
+
+def _process_chunk(functions, project_path, project_root, db_path):
+    results = [
+        (func['_key'], process_function(func, project_path, project_root, db_path, _WORKER["cache"]))
+        for func in functions
+    ]
+
+    stats = dict(STATS), dict(CACHE_STATS), METRICS.snapshot()
+    _reset_counters()
+    return results, stats
+
+
+def iter_results_parallel(functions, project_path, project_root, db_path, workers, tool_path, query_processes,
+                          graph=None, callgraph_timeout=None, chunk_size=16):
+    # small chunks handed out on demand, so a few expensive functions don't hold up a whole slice
+    chunks = [functions[i:i + chunk_size] for i in range(0, len(functions), chunk_size)]
+    _WORKER["graph"] = graph
+    process_chunk = partial(_process_chunk, project_path=project_path, project_root=project_root, db_path=db_path)
+
+    with Pool(workers, initializer=_init_worker,
+              initargs=(db_path, tool_path, query_processes, callgraph_timeout)) as pool, \
+            tqdm(total=len(functions)) as progress:
+        for results, (stats, cache_stats, metrics) in pool.imap_unordered(process_chunk, chunks):
+            for counters, update in ((STATS, stats), (CACHE_STATS, cache_stats)):
+                for k, v in update.items():
+                    counters[k] += v
+            METRICS.merge(metrics)
+            progress.update(len(results))
+            yield from results
+
+
+def iter_results(functions, project_path, project_root, db_path, workers=1, tool_path=TOOL_PATH, query_processes=1,
+                 graph=None, callgraph_timeout=None):
+    """
+    Yields (node key, (func id, data) or None or TIMED_OUT) as each function is processed.
+    With a `BulkGraph` the records and edges come from the bulk export, queries are only a fallback.
+    Callgraph queries use the adaptive `TIMEOUT_POLICY` unless `callgraph_timeout` fixes the deadline.
+    """
     project_path = os.path.abspath(project_path)
-    final_dataset = {}
+    if workers > 1:
+        yield from iter_results_parallel(functions, project_path, project_root, db_path, workers, tool_path,
+                                         query_processes, graph, callgraph_timeout)
+        return
 
+    TIMEOUT_POLICY.fixed = callgraph_timeout
+    cache = FuncInfoCache(db_path, graph)
     for func in tqdm(functions):
-        func_info = get_func_info(func['_key'], db_path, i=i)
-        is_valid = False
-        length = 0
-
-        if len(func_info) != 0:
-            func_info = func_info[0]
-            if project_root in func_info["pos"]["path"]:
-                length = func_info["end"]["line"] - func_info["pos"]["line"]
-                if length != 0:
-                    is_valid = True
-
-        if is_valid:
-            func_callgraph = get_callgraph(func_info["id"], db_path, func_info["pos"]["path"], i=i)
-            if func_callgraph:
-                data = process_callgraph(func_callgraph[0], db_path, i=i)
-                if data is not None:
-                    parse_groups(data, length)
-                    data["path"] = data["path"].replace(project_path, "", 1)[1:]
-                    final_dataset.update({func_info["id"]: data})
-    return final_dataset
-
-
-def get_next_json(data):
-    result = {}
-    for _, fn in data.iterrows():
-        result[fn.name] = []
-        for next_ in fn['next_funcs']:
-            res = {
-                "id": next_[0],
-                "name": next_[1],
-                "path": next_[2],
-                "start": next_[4],
-                "end": next_[5],
-            }
-            result[fn.name].append(res)
-
-    return result
+        yield func['_key'], process_function(func, project_path, project_root, db_path, cache)
+
+
+def get_dataset(functions, project_path, project_root, db_path, workers=1, tool_path=TOOL_PATH, query_processes=1,
+                graph=None):
+    results = dict(iter_results(functions, project_path, project_root, db_path, workers, tool_path, query_processes,
+                                graph))
+    return dict(
+        results[func['_key']] for func in functions
+        if results.get(func['_key']) not in (None, TIMED_OUT)
+    )
+
+
+def input_stamps(*paths):
+    """ Path, size and mtime of every given input (total size and latest mtime of a directory's files) """
+    stamps = {}
+    for path in paths:
+        if not path:
+            continue
+        if os.path.isdir(path):
+            stats = [os.stat(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files]
+            mtime = max((s.st_mtime_ns for s in stats), default=0)
+            stamps[os.path.abspath(path)] = [sum(s.st_size for s in stats), mtime]
+        else:
+            stat = os.stat(path) if os.path.exists(path) else None
+            stamps[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns] if stat else None
+    return stamps
+
+
+class Checkpoint:
+    """
+    Append-only jsonl with one line per processed node, written as soon as the function is done.
+    Rerunning with the same checkpoint skips the nodes it already holds. Timed out functions
+    are not recorded, so they are retried on the next run. The first line holds the `inputs` the checkpoint
+    was written for, a checkpoint of other inputs is discarded.
+    """
+
+    def __init__(self, path, inputs=None):
+        self.path = path
+        self.inputs = inputs or {}
+        if os.path.isfile(path) and self._header() != self.inputs:
+            print(f"Checkpoint {path} was written for other inputs, starting over")
+            os.remove(path)
+        self.done = {key for key, _ in self.read()}
+        self.file = None
+
+    def _header(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            try:
+                return json.loads(f.readline()).get("inputs")
+            except ValueError:
+                return None
+
+    def read(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # the line being written when the previous run died
+                if "key" in record:
+                    yield record["key"], record["result"]
+
+    def write(self, key, result):
+        if result == TIMED_OUT:
+            return
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+            if self.file.tell() == 0:
+                self.file.write(json.dumps({"inputs": self.inputs}) + "\n")
+            elif not self._ends_with_newline():
+                self.file.write("\n")  # don't glue the first record onto a truncated line
+        self.file.write(json.dumps({"key": key, "result": result}) + "\n")
+        self.file.flush()
+        self.done.add(key)
+
+    def _ends_with_newline(self):
+        with open(self.path, "rb") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--nodes-path')
+    parser.add_argument('--edges-path', default=None)
     parser.add_argument('--db-path')
     parser.add_argument('--project-path')
     parser.add_argument('--project-root')
     parser.add_argument('--out_path')
-    parser.add_argument('--parallel', type=int, default=-1)
-    parser.add_argument('--parallel-i', type=int, default=-1)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--codegraph-tool', default=TOOL_PATH)
+    parser.add_argument('--query-processes', type=int, default=1)
+    parser.add_argument('--checkpoint-path', default=None)
+    parser.add_argument('--graph-format', choices=["json", "jsonl"], default="json")
+    parser.add_argument('--metrics-path', default=None)
+    parser.add_argument('--metrics-period', type=float, default=60, help="seconds between metrics file updates")
+    parser.add_argument('--callgraph-timeout', type=float, default=10, help="longest first pass deadline")
+    parser.add_argument('--min-callgraph-timeout', type=float, default=1, help="shortest first pass deadline")
+    parser.add_argument('--retry-timeout', type=float, default=120)
+    parser.add_argument('--retry-workers', type=int, default=1)
 
     args = parser.parse_args()
+    open_session(args.db_path, args.codegraph_tool, args.query_processes)
 
-    if args.parallel == -1:
+    graph = None
+    if args.edges_path:
+        graph = load_bulk_graph(args.nodes_path, args.edges_path)
+        functions = [{'_key': func_id} for func_id in graph.functions]
+    else:
         with open(args.nodes_path, 'r') as file:
             functions = json.load(file)
 
-        dataset = get_dataset(functions, args.project_path, args.project_root, args.db_path)
-        data = pd.DataFrame.from_dict(dataset).transpose()
-
-        next_json = get_next_json(data)
-        with open(f"{args.out_path}.json", "w") as f:
-            json.dump(next_json, f)
-
-        data = data.drop("next_funcs", axis=1)
-        data = data.drop("prev_funcs", axis=1)
-        data.to_csv(f"{args.out_path}")
-        print(STATS)
-
-    elif args.parallel > -1 and args.parallel_i == -1:
-        next_json = {}
-        for i in range(args.parallel):
-            with open(f"{args.out_path}_{i}.csv.json") as f:
-                next_json.update(json.load(f))
-
-        with open(f"{args.out_path}.json", "w") as f:
-            json.dump(next_json, f)
-
-        result = pd.concat([
-            pd.read_csv(f"{args.out_path}_{i}.csv") for i in range(args.parallel)
-        ])
-        result.to_csv(f"{args.out_path}")
-
-    elif args.parallel > -1 and args.parallel_i > -1:
-        i = args.parallel_i
-        with open(args.nodes_path, 'r') as f:
-            functions = json.load(f)
-
-        n = len(functions) // args.parallel + 1
-        functions = functions[i * n:(i + 1) * n]
-
-        dataset = get_dataset(functions, args.project_path, args.project_root, args.db_path, i)
-        data = pd.DataFrame.from_dict(dataset).transpose()
-
-        next_json = get_next_json(data)
-        with open(f"{args.out_path}_{i}.csv.json", "w") as f:
-            json.dump(next_json, f)
-
-        data = data.drop("next_funcs", axis=1)
-        data = data.drop("prev_funcs", axis=1)
-        data.to_csv(f"{args.out_path}_{i}.csv")
-        print(args.parallel_i, STATS)
+    TIMEOUT_POLICY.initial = args.callgraph_timeout
+    TIMEOUT_POLICY.minimum = min(args.min_callgraph_timeout, args.callgraph_timeout)
+
+    checkpoint = Checkpoint(args.checkpoint_path or f"{args.out_path}.checkpoint.jsonl",
+                            input_stamps(args.nodes_path, args.edges_path, args.db_path))
+    metrics_path = args.metrics_path or f"{args.out_path}.metrics.json"
+    todo = [func for func in functions if func['_key'] not in checkpoint.done]
+    if len(todo) < len(functions):
+        print(f"Resuming from {checkpoint.path}: {len(functions) - len(todo)} functions already processed")
+
+    # outputs are rewritten from the checkpoint, then extended row by row as functions are processed
+    with DatasetWriter(args.out_path, args.graph_format) as writer, \
+            open(f"{args.out_path}.timeouts.jsonl", "a") as timeouts:
+
+        def consume(results, retry=False):
+            deferred = []
+            for key, result in results:
+                checkpoint.write(key, result)
+                if result == TIMED_OUT:
+                    deferred.append(key)
+                elif result is not None:
+                    writer.write(*result)
+                if retry or result != TIMED_OUT:
+                    METRICS.function_done()
+                if retry:
+                    timeouts.write(json.dumps({"key": key, "resolved": result != TIMED_OUT}) + "\n")
+                METRICS.write_every(metrics_path, args.metrics_period)
+            return deferred
+
+        for _, result in checkpoint.read():
+            if result is not None:
+                writer.write(*result)
+
+        try:
+            deferred = consume(iter_results(todo, args.project_path, args.project_root, args.db_path, args.workers,
+                                            args.codegraph_tool, args.query_processes, graph))
+            if deferred:
+                # the slow tail gets a long deadline and little concurrency so it doesn't starve itself
+                print(f"Retrying {len(deferred)} timed out functions with a {args.retry_timeout}s deadline")
+                deferred = set(deferred)
+                retry = [func for func in todo if func['_key'] in deferred]
+                dropped = consume(iter_results(retry, args.project_path, args.project_root, args.db_path,
+                                               args.retry_workers, args.codegraph_tool, args.query_processes, graph,
+                                               args.retry_timeout), retry=True)
+                if dropped:
+                    print(f"{len(dropped)} functions timed out twice, they are listed in {timeouts.name} "
+                          f"and will be retried on the next run")
+        finally:
+            checkpoint.close()
+            METRICS.write(metrics_path)
+
+    print(STATS, CACHE_STATS)
 
 
 if __name__ == '__main__':
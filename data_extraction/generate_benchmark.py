@@ -1,17 +1,23 @@
+import hashlib
 import json
 import os.path
 import re
 from collections import Counter, defaultdict
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
-from nltk.translate.bleu_score import sentence_bleu
 from pandas import DataFrame
-from tqdm import tqdm
+
+from near_duplicates import find_duplicates, lsh_recall
+from source_store import source_lines
+from table_filters import FilterEngine
 
 VERSION = "bench-v0.6"
 REPOSITORIES = ["bullet3", "openssl", "redis", "llvm"]
 EDGES = ["stdlib", "same_file", "same_package", "project"]
+DUPLICATE_WORKERS = os.cpu_count() or 1
+CODE_BLOBS = False  # True stores callee code once in the json "blobs" table, calls keep its "code_ref"
 
 EXAMPLES_PER_REPO = 155
 EXAMPLES_PER_BENCH = 70
@@ -32,83 +38,100 @@ EXAMPLES_PROPORTIONS = {  # "bench-v0.1a"
 EXAMPLES_PROPORTIONS = {k: v / s for k, v in EXAMPLES_PROPORTIONS.items() if (s := sum(EXAMPLES_PROPORTIONS.values()))}
 
 
-def edge_level(f):
-    for e in EDGES[::-1]:
-        if f[e] > 0:
-            return e
-    return "none"
+FN_DEFINITION = r"[a-zA-Z0-9_]+[ \n\t\r]?\([ \n\t\r&,_a-zA-Z0-9]+\)[ \n\t\r]*{"
 
 
-def has_test_hits(f):
-    return f.test_cov_hits > 0
+def edge_levels(df):
+    """ The furthest edge kind every row calls over, "none" without calls """
+    return np.select([df[e] > 0 for e in EDGES[::-1]], EDGES[::-1], default="none")
 
 
-def has_docstring(f, length=3):
-    if "Copyright" in f.doc:
-        return False
-    if "====" in f.doc:
-        return False
-    if re.search(r"[a-zA-Z0-9_]+[ \n\t\r]?\([ \n\t\r&,_a-zA-Z0-9]+\)[ \n\t\r]*{", f.doc) and "}" in f.doc:
-        return False
-    return f.doc and len(str(f.doc).split()) > length
+def docstring_valid(df, length=3):
+    doc = df.doc.astype(str)
+    return (
+        ~doc.str.contains("Copyright", regex=False)
+        & ~doc.str.contains("====", regex=False)
+        & ~(doc.str.contains(FN_DEFINITION) & doc.str.contains("}", regex=False))
+        & (doc.str.split().str.len() > length)
+    )
 
 
-def has_proper_code_len(f, low=2, high=15):
+def code_body_lines(code):
     # in lines of code
-    code = extract_code(f.file, f.pos - 1, f.code_length)
-    i = code.find("{")
-    j = code.rfind("}")
-    code_length = len(code[i+1:j].strip().split("\n"))
-    return low <= code_length <= high
+    lines = []
+    for c in code:
+        i = c.find("{")
+        j = c.rfind("}")
+        lines.append(len(c[i+1:j].strip().split("\n")))
+    return lines
+
+
+def has_test_hits(engine):
+    return engine.df.test_cov_hits > 0
+
+
+def has_docstring(engine):
+    return engine.get("docstring_valid")
 
 
-def is_not_test(f):
-    return "test" not in f.file and "test" not in f.fname
+def has_proper_code_len(engine, low=2, high=15):
+    return engine.get("body_lines").between(low, high)
+
+
+def is_not_test(engine):
+    df = engine.df
+    return ~df.file.str.contains("test", regex=False) & ~df.fname.str.contains("test", regex=False)
 
 
 def docstring_ok():
     docstring_215 = pd.read_csv("bench/docstring_215.csv")
     docstring_215["bad"] = docstring_215.apply(lambda x: f"{x.reviewer1}{x.reviewer2}{x.reviewer3}".count("-") >= 2, axis=1)
     docstring_labels = {x["Unnamed: 0.1.1"]: x["bad"] for _, x in docstring_215.iterrows()}
+    bad_ids = [i for i, bad in docstring_labels.items() if bad]
 
-    def docstring_ok_(f):
-        bad = docstring_labels.get(f["Unnamed: 0"], False)
-        return not bad
+    def docstring_ok_(engine):
+        return ~engine.df["Unnamed: 0"].isin(bad_ids)
     return docstring_ok_
 
 
-def has_few_calls(f, max_num_calls=7):
-    return f.calls_num <= max_num_calls
+def has_few_calls(engine, max_num_calls=7):
+    return engine.df.calls_num <= max_num_calls
+
+
+def benchmark_filters(df):
+    """ Benchmark filters over `df`, the ones reading source files run after the column checks """
+    engine = FilterEngine(df)
+    engine.column("docstring_valid", lambda e, d: docstring_valid(d))
+    engine.column("code", lambda e, d: [extract_code(f, pos - 1, n) for f, pos, n in zip(d.file, d.pos, d.code_length)])
+    engine.column("body_lines", lambda e, d: code_body_lines(e.get("code").loc[d.index]))
 
+    for f in [has_test_hits, is_not_test, has_few_calls, docstring_ok(), has_docstring]:
+        engine.add_filter(f.__name__.rstrip("_"), f)
+    engine.add_filter("has_proper_code_len", has_proper_code_len, cost=1)
+    engine.add_filter("filter_duplicates_weak", lambda e: filter_duplicates_weak(e.df, code=e.get("code")), cost=2, table=True)
+    return engine
 
-def filter_duplicates_weak(df: DataFrame, window=3000, bleu_thresh=0.2):
+
+def filter_duplicates_weak(df: DataFrame, window=3000, bleu_thresh=0.2, method="window", check_recall=False,
+                           workers=DUPLICATE_WORKERS, code=None):
+    # method="lsh" searches the whole table through a MinHash LSH index instead of the length window,
+    # workers > 1 computes the duplicates of row shards in a pool, the result is the same as with one,
+    # `code` of the rows by index saves extracting it again
     df = df.sort_values(by="code_length")
     rows_txt = df.apply(lambda x: f"{x['fname']} {x['doc']}", axis=1).values
-    code = []
-    for _, row in df.iterrows():
-        code.append(extract_code(row.file, row.pos - 1, row.code_length))
+    if code is not None:
+        code = list(code.loc[df.index])
+    else:
+        code = [extract_code(row.file, row.pos - 1, row.code_length) for _, row in df.iterrows()]
 
     rows_txt = [re.sub(r"[^a-zA-Z0-9]", " ", f"{s} {c}") for s, c in zip(rows_txt, code)]
     rows_txt = [re.sub(r"\s+", " ", s).split() for s in rows_txt]
     calls_num = df.calls_num.values
 
     df = df.reset_index(drop=True)
-    duplicates = set()
-    for i, row in tqdm(df.iterrows(), total=len(df)):
-        if not isinstance(i, int):
-            print("warning: df index type")
-            continue
-
-        if i in duplicates:
-            continue
-
-        candidate_ids = [
-            j for j in range(i + 1, i + window)
-            if j < len(rows_txt) and abs(calls_num[i] - calls_num[j]) <= 3 and len(set(rows_txt[i]) & set(rows_txt[j])) >= 5
-        ]
-        for j in candidate_ids:
-            if sentence_bleu([rows_txt[i]], rows_txt[j], weights=(0.5, 0.5)) >= bleu_thresh:
-                duplicates.add(j)
+    duplicates = find_duplicates(rows_txt, calls_num, window, bleu_thresh, method, workers=workers)
+    if check_recall:
+        print("LSH recall:", lsh_recall(rows_txt, calls_num, window, bleu_thresh))
 
     df = df[~df.index.isin(duplicates)]
     df = df.reset_index(drop=True)
@@ -116,8 +139,7 @@ def filter_duplicates_weak(df: DataFrame, window=3000, bleu_thresh=0.2):
 
 
 def extract_code(path, start, length):
-    with open(f"repos/{path}", encoding="utf-8") as f:
-        lines = f.readlines()
+    lines = source_lines(f"repos/{path}")
     code = lines[start:start + length + 1]
     result = "".join(code)
     if "#if" in result and "#else" in result:
@@ -140,12 +162,19 @@ def extract_code(path, start, length):
     return result
 
 
-def generate_json(df, path):
+def code_ref(code, blobs):
+    ref = hashlib.sha256(code.encode("utf-8")).hexdigest()
+    blobs.setdefault(ref, code)
+    return ref
+
+
+def generate_json(df, path, code_blobs=CODE_BLOBS):
     jsons = {}
     for repo in REPOSITORIES:
         with open(f"final_table_wHits/{repo}.json", "r") as f:
             jsons[repo] = json.load(f)
     final = defaultdict(dict)
+    blobs = {}
     for _, row in df.iterrows():
         i = row["Unnamed: 0"]
         final[i]["calls"] = jsons[row.repository][i]
@@ -153,10 +182,16 @@ def generate_json(df, path):
             if c["path"] and "/usr/include" not in c["path"]:
                 c["path"] = "/".join(c["path"].split("/")[5:])
                 if os.path.exists(f"repos/{c['path']}"):
-                    c["code"] = extract_code(c["path"], c["start"]["line"], c["end"]["line"])
+                    code = extract_code(c["path"], c["start"]["line"], c["end"]["line"])
+                    if code_blobs:
+                        c["code_ref"] = code_ref(code, blobs)
+                    else:
+                        c["code"] = code
                 else:
                     print(f"Path {c['path']} not found for {i}")
         final[i]["code"] = extract_code(row.file, row.pos - 1, row.code_length)
+    if code_blobs:
+        final["blobs"] = blobs
 
     with open(path, "w") as f:
         json.dump(final, f)
@@ -179,40 +214,29 @@ def main():
     df = df.dropna(subset="last_commit")
     df["doc"] = df["doc"].astype(str)
 
-    code = []
-    for _, row in df.iterrows():
-        code.append(extract_code(row.file, row.pos - 1, row.code_length))
-
-    # plot_len_hist(code)
-    # raise
-
-    def print_filtered(before_, after, text):
+    def print_filtered(before_, after, text, seconds):
         d = before_ - after
-        print(f"FILTER: {text}\n\tfiltered {d} rows (-{100*d/before_:.1f}%), {after} rows left")
+        print(f"FILTER: {text}\n\tfiltered {d} rows (-{100*d/max(before_, 1):.1f}%), {after} rows left"
+              f" ({seconds:.2f}s, selectivity {after/max(before_, 1):.3f})")
 
-    filter_list = [
-        has_test_hits, has_docstring, has_proper_code_len, is_not_test, docstring_ok(), has_few_calls
-    ]
-    for f in filter_list:
-        before = len(df)
-        df = df[df.apply(lambda row: f(row), axis=1)]
-        print_filtered(before, len(df), f.__name__)
+    engine = benchmark_filters(df)
+    df = engine.run(print_filtered)
 
-    before = len(df)
-    df = filter_duplicates_weak(df)
-    print_filtered(before, len(df), "filter_duplicates_weak")
+    # plot_len_hist(engine.get("code"))
+    # raise
 
+    df["edge_level"] = edge_levels(df)
     df["commit_stamp"] = df.apply(lambda row: datetime.strptime(row.last_commit, '%d.%m.%Y').timestamp(), axis=1)
 
     final = []
     dev = []
     for repo in REPOSITORIES:
         table = df[df.repository == repo]
-        edges = Counter(table.apply(lambda row: edge_level(row), axis=1).values)
+        edges = Counter(table.edge_level.values)
         edges = sorted(edges.items(), key=lambda x: x[1])
         edges = [x[0] for x in edges]
         for e in edges:
-            level_rows = table[table.apply(lambda row: edge_level(row), axis=1) == e]
+            level_rows = table[table.edge_level == e]
             level_rows = level_rows.sort_values(by=["commit_stamp", "test_cov_hits"], ascending=[False, False])
             level_rows = level_rows.reset_index(drop=True)
             level_rows = level_rows.head(int(EXAMPLES_PER_REPO * EXAMPLES_PROPORTIONS[e]))
@@ -228,11 +252,11 @@ def main():
     print("BENCH")
     print(len(df))
     print(Counter(df.repository.values))
-    print(Counter(df.apply(lambda row: edge_level(row), axis=1).values))
+    print(Counter(df.edge_level.values))
     for repo in REPOSITORIES:
-        print(repo, "\n\t", Counter(df[df["repository"] == repo].apply(lambda row: edge_level(row), axis=1).values))
+        print(repo, "\n\t", Counter(df[df["repository"] == repo].edge_level.values))
 
-    df.drop("commit_stamp", axis=1, inplace=True)
+    df.drop(["commit_stamp", "edge_level"], axis=1, inplace=True)
     generate_json(df, f"{VERSION}.json")
     df.to_csv(f"{VERSION}.csv")
 
@@ -242,11 +266,11 @@ def main():
     print("DEV")
     print(len(df_dev))
     print(Counter(df_dev.repository.values))
-    print(Counter(df_dev.apply(lambda row: edge_level(row), axis=1).values))
+    print(Counter(df_dev.edge_level.values))
     for repo in REPOSITORIES:
-        print(repo, "\n\t", Counter(df_dev[df_dev["repository"] == repo].apply(lambda row: edge_level(row), axis=1).values))
+        print(repo, "\n\t", Counter(df_dev[df_dev["repository"] == repo].edge_level.values))
 
-    df_dev.drop("commit_stamp", axis=1, inplace=True)
+    df_dev.drop(["commit_stamp", "edge_level"], axis=1, inplace=True)
     generate_json(df_dev, f"{VERSION}_dev.json")
     df_dev.to_csv(f"{VERSION}_dev.csv")
 
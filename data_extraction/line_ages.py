@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+from datetime import date, datetime
+
+import numpy as np
+
+
+INDEX_SUFFIX = ".index.json"
+TMP_SUFFIX = ".tmp"
+
+
+def day_number(timestamp):
+    """ Day of the commit as a date ordinal (1 is 01.01.0001), 0 is left for lines without a date """
+    return datetime.fromtimestamp(timestamp).date().toordinal()
+
+
+def parse_day(s):
+    return datetime.strptime(s, '%d.%m.%Y').date().toordinal()
+
+
+def format_day(day):
+    return date.fromordinal(int(day)).strftime('%d.%m.%Y')
+
+
+def parse_days(dates, cache=None):
+    """ Day numbers of a list of dd.mm.yyyy strings, each distinct string is parsed once """
+    cache = {} if cache is None else cache
+    days = np.zeros(len(dates), dtype=np.uint32)
+    for i, d in enumerate(dates):
+        if d not in cache:
+            cache[d] = parse_day(d)
+        days[i] = cache[d]
+    return days
+
+
+class RangeMax:
+    """
+    Sparse table over day numbers: level j holds the maxima of all windows of 2^j lines,
+    so the maximum of any range is the larger of two overlapping windows.
+    """
+
+    def __init__(self, days):
+        self.levels = [np.asarray(days, dtype=np.uint32)]
+        width = 1
+        while 2 * width <= len(days):
+            prev = self.levels[-1]
+            self.levels.append(np.maximum(prev[:-width], prev[width:]))
+            width *= 2
+
+    def query(self, starts, ends):
+        """ Maxima of [start, end) for arrays of ranges clipped to the lines, 0 for empty ones """
+        n = len(self.levels[0])
+        starts = np.clip(np.asarray(starts, dtype=np.int64), 0, n)
+        ends = np.clip(np.asarray(ends, dtype=np.int64), 0, n)
+        result = np.zeros(len(starts), dtype=np.uint32)
+
+        nonempty = ends > starts
+        lengths = ends - starts
+        levels = np.zeros(len(starts), dtype=np.int64)
+        levels[nonempty] = np.floor(np.log2(lengths[nonempty])).astype(np.int64)
+        for j in np.unique(levels[nonempty]):
+            rows = np.flatnonzero(nonempty & (levels == j))
+            level = self.levels[j]
+            result[rows] = np.maximum(level[starts[rows]], level[ends[rows] - (1 << j)])
+        return result
+
+
+class LineAgeWriter:
+    """
+    Writes the day numbers of every line of every file back to back as uint32 into `path`,
+    with `{path}.index.json` holding {file: [offset, number of lines]}. Both are written next to their
+    destination and moved over it on close, so `path` can be the `LineAges` being refreshed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path + TMP_SUFFIX, "wb")
+        self.index = {}
+        self.offset = 0
+
+    def write(self, file, lines):
+        """ `lines` is {line number starting from 1: day number} or the day numbers of all lines """
+        if isinstance(lines, dict):
+            days = np.zeros(max(map(int, lines), default=0), dtype=np.uint32)
+            for i, day in lines.items():
+                days[int(i) - 1] = day
+        else:
+            days = np.asarray(lines, dtype=np.uint32)
+        self.file.write(days.tobytes())
+        self.index[file] = [self.offset, len(days)]
+        self.offset += len(days)
+
+    def close(self):
+        self.file.close()
+        with open(self.path + INDEX_SUFFIX + TMP_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(self.path + TMP_SUFFIX, self.path)
+        os.replace(self.path + INDEX_SUFFIX + TMP_SUFFIX, self.path + INDEX_SUFFIX)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path + TMP_SUFFIX)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class LineAges:
+    """ Memory-mapped `LineAgeWriter` output, indexing by file gives its day numbers, line i at i - 1 """
+
+    def __init__(self, path):
+        with open(path + INDEX_SUFFIX, "r", encoding="utf-8") as f:
+            self.index = {k.replace("\\", "/"): v for k, v in json.load(f).items()}
+        self.days = np.memmap(path, dtype=np.uint32, mode="r") \
+            if os.path.getsize(path) > 0 else np.zeros(0, dtype=np.uint32)
+
+    def __contains__(self, file):
+        return file in self.index
+
+    def __getitem__(self, file):
+        offset, n = self.index[file]
+        return self.days[offset:offset + n]
+
+    def get(self, file, default=None):
+        return self[file] if file in self else default
+
+    def keys(self):
+        return self.index.keys()
+
+
+def is_line_ages(path):
+    return os.path.isfile(path + INDEX_SUFFIX)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commits-path', help="commit_dates.py json output to convert")
+    parser.add_argument('--out-path')
+
+    args = parser.parse_args()
+
+    with open(args.commits_path, "r", encoding="utf-8") as f:
+        commits = json.load(f)
+
+    with LineAgeWriter(args.out_path) as writer:
+        for file, lines in commits.items():
+            writer.write(file, {int(i): parse_day(d) for i, d in lines.items()})
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,13 @@
 import argparse
-import datetime
 import json
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from codegraph_client import TOOL_PATH, open_session
 from db_stat import get_func_info
+from line_ages import LineAges, RangeMax, format_day, is_line_ages, parse_days
 
 
 def add_pos(csv, db_path):
@@ -18,42 +20,59 @@ def add_pos(csv, db_path):
 
 
 def add_commits(main_table, commits):
-    commit_date = []
-    for index, row in tqdm(main_table.iterrows()):
-        if row["path"] in commits.keys():
-            com = commits[row["path"]]
-            if len(com) != 0:
-                start = row["pos"]
-                end = start + row["code_length"]
-                func_lines = com[start-1:end-1]
-                func_lines = sorted(func_lines, key=lambda x: datetime.datetime.strptime(x, '%d.%m.%Y'))
-                last_commit = ""
-                if len(func_lines) != 0:
-                    last_commit = func_lines[-1]
-                commit_date.append(last_commit)
-        else:
-            commit_date.append("")
-    main_table["last_commit"] = commit_date
+    """
+    Last commit date of every function's lines from {path: day numbers of its lines}, json dates converted with
+    `parse_days` or `LineAges`. Each file gets a `RangeMax` and all of its functions are looked up at once.
+    """
+    last_days = np.zeros(len(main_table), dtype=np.uint32)
+    paths = main_table["path"].fillna("").astype(str).str.replace("\\", "/", regex=False)
+    starts = main_table["pos"].to_numpy(dtype=np.int64) - 1
+    ends = starts + main_table["code_length"].to_numpy(dtype=np.int64)
+
+    for path, rows in tqdm(paths.groupby(paths).indices.items()):
+        days = commits.get(path)
+        if days is None or len(days) == 0:
+            continue
+        last_days[rows] = RangeMax(days).query(starts[rows], ends[rows])
+
+    dates = {d: format_day(d) for d in np.unique(last_days) if d}
+    main_table["last_commit"] = [dates.get(d, "") for d in last_days]
+
+
+def add_function_dates(main_table, function_dates):
+    """ Takes last commit dates from the `commit_dates.py --table-path` output instead of per-line dates """
+    main_table["last_commit"] = main_table[main_table.columns[0]].map(function_dates).fillna("")
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--table-path')
-    parser.add_argument('--db-path')
-    parser.add_argument('--commits-path')
+    parser.add_argument('--db-path', help="only queried for tables without the pos column")
+    parser.add_argument('--commits-path', help="commit_dates.py output, json or `.ages` line-age files")
+    parser.add_argument('--function-dates-path', help="commit_dates.py --table-path output, replaces --commits-path")
     parser.add_argument('--out-path')
+    parser.add_argument('--codegraph-tool', default=TOOL_PATH)
 
     args = parser.parse_args()
 
     table = pd.read_csv(args.table_path)
 
-    with open(args.commits_path, 'r') as f:
-        commits = json.load(f)
-        commits = {k.replace("\\", '/'): v for k, v in commits.items()}
-        commits = {k: [date for _, date in v.items()] for k, v in commits.items()}
-
-    add_pos(table, args.db_path)
-    add_commits(table, commits)
+    if "pos" not in table.columns:
+        # tables written before db_stat.py kept the positions
+        open_session(args.db_path, args.codegraph_tool)
+        add_pos(table, args.db_path)
+
+    if args.function_dates_path:
+        with open(args.function_dates_path, 'r') as f:
+            add_function_dates(table, json.load(f))
+    elif is_line_ages(args.commits_path):
+        add_commits(table, LineAges(args.commits_path))
+    else:
+        with open(args.commits_path, 'r') as f:
+            commits = json.load(f)
+            cache = {}
+            commits = {k.replace("\\", '/'): parse_days(list(v.values()), cache) for k, v in commits.items()}
+        add_commits(table, commits)
 
     table.to_csv(args.out_path)
 
@@ -1,69 +1,94 @@
 import argparse
-import re
-from collections import defaultdict
+from itertools import chain
 
+import numpy as np
 import pandas as pd
 
+from coverage_export import FORMATS, iter_coverage_chunks
+
 
 def read(args, print_head=False):
     final = pd.read_csv(args.table_path, delimiter=args.table_delim)
-    coverage = pd.read_csv(args.test_cov_path, delimiter=args.test_cov_delim)
+    # coverage dumps may not fit into memory, they are read and aggregated chunk by chunk
+    if args.test_cov_format == "tsv":
+        coverage = chain.from_iterable(
+            pd.read_csv(path, delimiter=args.test_cov_delim, chunksize=args.chunk_size) for path in args.test_cov_path
+        )
+    else:
+        coverage = iter_coverage_chunks(args.test_cov_path, args.test_cov_format, args.chunk_size)
 
     final["file_"] = final["path"]
-    final.path = final.path.apply(lambda s: s.replace(args.table_path_prefix, ""))
+    final.path = final.path.str.replace(args.table_path_prefix, "", regex=False)
     final.rename(columns={'path': 'file', "name": "fname"}, inplace=True)
-    coverage.file = coverage.file.apply(lambda s: s.replace(args.test_cov_path_prefix, ""))
+
+    def strip_prefix(chunk):
+        chunk.file = chunk.file.str.replace(args.test_cov_path_prefix, "", regex=False)
+        return chunk
+
+    coverage = map(strip_prefix, coverage)
 
     if print_head:
         pd.set_option('display.expand_frame_repr', False)
         pd.set_option('max_colwidth', 400)
         print(final.head(5))
-        print(coverage.head(5))
+        first = next(coverage, None)
+        if first is not None:
+            print(first.head(5))
+            coverage = chain([first], coverage)
     return final, coverage
 
 
-def print_files_stats(table, coverage):
+def print_files_stats(table, cov_files):
     print("Files:")
     table_set = set(table.file.values)
-    cov_set = set(coverage.file.values)
     print("\tTable:", len(table_set))
-    print("\tCoverage:", len(cov_set))
-    print("\tIntersection:", len(table_set & cov_set))
+    print("\tCoverage:", len(cov_files))
+    print("\tIntersection:", len(table_set & cov_files))
 
 
-def get_cov_dict(coverage):
-    cov_dict = defaultdict(lambda: defaultdict(int))
-    for _, line in coverage.iterrows():
-        f = line.fname.split("(")[0].strip().replace("void ", "")
-        f = re.sub(r"<.*>", "", f).strip()
-        if "test" not in f and ".inc" not in line.file:
-            cov_dict[line.file.strip()][f] += line.hits
+def normalize_fnames(fnames):
+    """ Drops arguments, `void ` and template arguments from coverage function names """
+    fnames = fnames.str.split("(", n=1).str[0].str.strip().str.replace("void ", "", regex=False)
+    return fnames.str.replace(r"<.*>", "", regex=True).str.strip()
 
-    return cov_dict
 
+def get_cov_hits(coverage, cov_files=None):
+    """
+    Total hits per (file, fname) of the coverage chunks as a frame keyed by both, test functions and `.inc`
+    files left out. File names seen in the coverage are collected into `cov_files` if given.
+    """
+    cov_hits = pd.DataFrame({"file": pd.Series(dtype=str), "fname": pd.Series(dtype=str), "hits": []})
+    for chunk in coverage:
+        if cov_files is not None:
+            cov_files.update(chunk.file.dropna().unique())
+        fnames = normalize_fnames(chunk.fname)
+        keep = ~fnames.str.contains("test", regex=False, na=True) & \
+            ~chunk.file.str.contains(".inc", regex=False, na=True)
+        chunk = pd.DataFrame({"file": chunk.file[keep].str.strip(), "fname": fnames[keep], "hits": chunk.hits[keep]})
+        cov_hits = pd.concat([cov_hits, chunk]).groupby(["file", "fname"], as_index=False, sort=False)["hits"].sum()
 
-def print_fn_stats(table, cov_dict):
+    return cov_hits
+
+
+def print_fn_stats(table, cov_hits):
     print("Functions:")
     print("\tTable:", len(table))
-    print("\tCoverage:", sum(len(v) for v in cov_dict.values()))
-    intersection = set(table.fname.values) & set([k for d in cov_dict.values() for k in d])
+    print("\tCoverage:", len(cov_hits))
+    intersection = set(table.fname.values) & set(cov_hits.fname.values)
     print("\tIntersection:", len(intersection))
 
 
-def merge_hits(table, cov_dict, args):
-    hits = []
-    for _, row in table.iterrows():
-        h = None
-        p, n = row.file.strip(), row.fname.strip()
-        if p in cov_dict:
-            if n in cov_dict[p]:
-                h = int(cov_dict[p][n])
-        hits.append(h)
+def merge_hits(table, cov_hits, args):
+    keys = pd.DataFrame({"file": table.file.str.strip(), "fname": table.fname.str.strip()})
+    hits = keys.merge(cov_hits, on=["file", "fname"], how="left")["hits"]
+    hits = np.trunc(hits.astype(float))
+    if hits.notna().all():
+        hits = hits.astype(np.int64)
 
     if args.print:
-        print("Functions with hits:", sum(x is not None for x in hits), "/", len(hits))
+        print("Functions with hits:", hits.notna().sum(), "/", len(hits))
 
-    table = table.assign(test_cov_hits=pd.Series(hits).values)
+    table = table.assign(test_cov_hits=hits.values)
     return table
 
 
@@ -118,22 +143,25 @@ def main():
     parser.add_argument('--table-path', default="final_tables/bullet3_final.csv")
     parser.add_argument('--table-delim', default=",")
     parser.add_argument('--table-path-prefix', default="bullet3/")
-    parser.add_argument('--test-cov-path', default="test_covs/bullet3_test_cov.csv")
+    parser.add_argument('--test-cov-path', nargs="+", default=["test_covs/bullet3_test_cov.csv"])
+    parser.add_argument('--test-cov-format', choices=["tsv"] + FORMATS, default="tsv",
+                        help="gcov --json-format (.gcov.json.gz) or llvm-cov export json files instead of the tsv")
     parser.add_argument('--test-cov-delim', default="\t")
     parser.add_argument('--test-cov-path-prefix', default="")
     parser.add_argument('--project', default="bullet3")
     parser.add_argument('--print', default=True)
+    parser.add_argument('--chunk-size', type=int, default=1000000, help="coverage rows read at once")
 
     args = parser.parse_args()
     table, coverage = read(args, print_head=args.print)
-    if args.print:
-        print_files_stats(table, coverage)
 
-    cov_dict = get_cov_dict(coverage)
+    cov_files = set()
+    cov_hits = get_cov_hits(coverage, cov_files)
     if args.print:
-        print_fn_stats(table, cov_dict)
+        print_files_stats(table, cov_files)
+        print_fn_stats(table, cov_hits)
 
-    final = merge_hits(table, cov_dict, args)
+    final = merge_hits(table, cov_hits, args)
     if args.print:
         print(final.head(5))
 
@@ -0,0 +1,257 @@
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+from nltk.translate.bleu_score import sentence_bleu
+from tqdm import tqdm
+
+
+MIN_SHARED_TOKENS = 5
+MAX_CALLS_DIFF = 3
+_MAX_HASH = np.iinfo(np.uint64).max
+
+
+def _mix(x):
+    # splitmix64 finalizer, wraps around in uint64
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class MinHashLSH:
+    """
+    MinHash signatures of token sets split into `bands` bands of `num_perm // bands` rows, functions sharing
+    a band are candidate duplicates. Sets with Jaccard similarity above about (1 / bands) ** (bands / num_perm)
+    are likely to share one. Buckets larger than `max_bucket` only pair each member with the next
+    `max_bucket` members.
+    """
+
+    def __init__(self, num_perm=120, bands=40, max_bucket=1000, seed=0, block_tokens=1 << 16):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_bucket = max_bucket
+        self.block_tokens = block_tokens
+        self.seeds = rng.integers(0, _MAX_HASH, num_perm, dtype=np.uint64)
+        self.band_coeffs = rng.integers(1, _MAX_HASH, self.rows, dtype=np.uint64, endpoint=False) | np.uint64(1)
+
+    def signatures(self, token_sets):
+        vocab = {}
+        ids = [np.array([vocab.setdefault(t, len(vocab)) for t in tokens], dtype=np.uint64) for tokens in token_sets]
+        result = np.full((len(ids), self.num_perm), _MAX_HASH, dtype=np.uint64)
+
+        start = 0
+        while start < len(ids):
+            end, size = start, 0
+            while end < len(ids) and (end == start or size + len(ids[end]) <= self.block_tokens):
+                size += len(ids[end])
+                end += 1
+            rows = [i for i in range(start, end) if len(ids[i])]
+            if rows:
+                block = np.concatenate([ids[i] for i in rows])
+                offsets = np.cumsum([0] + [len(ids[i]) for i in rows[:-1]])
+                hashes = _mix(block[:, None] ^ self.seeds[None, :])
+                result[rows] = np.minimum.reduceat(hashes, offsets, axis=0)
+            start = end
+        return result
+
+    def _band_pairs(self, keys, rows):
+        order = np.lexsort((rows, keys))
+        keys, members = keys[order], rows[order]
+        pairs = []
+        # positions followed by a member of the same bucket, pairs at distance d grow out of those at d - 1
+        idx = np.flatnonzero(keys[:-1] == keys[1:])
+        d = 1
+        while len(idx) and d <= self.max_bucket:
+            pairs.append(np.stack([members[idx], members[idx + d]], axis=1))
+            idx = idx[idx + d + 1 < len(keys)]
+            idx = idx[keys[idx + d + 1] == keys[idx]]
+            d += 1
+        return pairs
+
+    def candidate_pairs(self, token_sets, min_tokens=1):
+        """ Sorted unique (i, j), i < j, of functions sharing a bucket in any band """
+        rows = np.array([i for i, tokens in enumerate(token_sets) if len(tokens) >= min_tokens], dtype=np.int64)
+        if len(rows) < 2:
+            return np.zeros((0, 2), dtype=np.int64)
+
+        signatures = self.signatures([token_sets[i] for i in rows])
+        n = len(token_sets)
+        codes = []
+        for band in range(self.bands):
+            band_signatures = signatures[:, band * self.rows:(band + 1) * self.rows]
+            keys = (band_signatures * self.band_coeffs[None, :]).sum(axis=1)
+            for pairs in self._band_pairs(keys, rows):
+                codes.append(pairs[:, 0] * n + pairs[:, 1])
+
+        if not codes:
+            return np.zeros((0, 2), dtype=np.int64)
+        codes = np.unique(np.concatenate(codes))
+        return np.stack([codes // n, codes % n], axis=1)
+
+
+def _csr(rows):
+    """ Sorted distinct feature ids and their counts of every row, concatenated with row offsets """
+    indptr, ids, counts = [0], [], []
+    for features in rows:
+        row_ids, row_counts = np.unique(features, return_counts=True)
+        ids.append(row_ids)
+        counts.append(row_counts)
+        indptr.append(indptr[-1] + len(row_ids))
+    return (
+        np.array(indptr, dtype=np.int64),
+        np.concatenate(ids).astype(np.int64) if ids else np.zeros(0, dtype=np.int64),
+        np.concatenate(counts).astype(np.int64) if counts else np.zeros(0, dtype=np.int64),
+    )
+
+
+class Bleu2Scorer:
+    """
+    Unigram and bigram counts of every row kept once as sparse arrays, `score(i, js)` gives
+    sentence_bleu([rows_txt[i]], rows_txt[j], weights=(0.5, 0.5)) for all `js` in one go: clipped counts
+    over max(1, hypothesis n-grams), 0 without unigram matches, sys.float_info.min for a precision without
+    matches (no smoothing) and the brevity penalty against the reference length.
+    """
+
+    def __init__(self, rows_txt):
+        vocab = {}
+        tokens = [np.array([vocab.setdefault(t, len(vocab)) for t in row], dtype=np.int64) for row in rows_txt]
+        size = max(len(vocab), 1)
+        self.lengths = np.array([len(row) for row in tokens], dtype=np.int64)
+        self.unigrams = _csr(tokens)
+        self.bigrams = _csr(row[:-1] * size + row[1:] for row in tokens)
+
+    @staticmethod
+    def _clipped(table, i, js):
+        """ Clipped matching counts and the number of distinct matching n-grams of rows `js` against row i """
+        indptr, ids, counts = table
+        ref_ids, ref_counts = ids[indptr[i]:indptr[i + 1]], counts[indptr[i]:indptr[i + 1]]
+        starts, sizes = indptr[js], indptr[js + 1] - indptr[js]
+        if len(ref_ids) == 0 or sizes.sum() == 0:
+            return np.zeros(len(js)), np.zeros(len(js))
+
+        owner = np.repeat(np.arange(len(js)), sizes)
+        positions = np.arange(sizes.sum()) + np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
+        hyp_ids, hyp_counts = ids[positions], counts[positions]
+        found = np.minimum(np.searchsorted(ref_ids, hyp_ids), len(ref_ids) - 1)
+        matched = ref_ids[found] == hyp_ids
+        clipped = np.where(matched, np.minimum(hyp_counts, ref_counts[found]), 0)
+        return (np.bincount(owner, weights=clipped, minlength=len(js)),
+                np.bincount(owner, weights=matched, minlength=len(js)))
+
+    def shared_tokens(self, i, js):
+        """ len(set(rows_txt[i]) & set(rows_txt[j])) for all `js` """
+        return self._clipped(self.unigrams, i, np.asarray(js, dtype=np.int64))[1]
+
+    def score(self, i, js):
+        js = np.asarray(js, dtype=np.int64)
+        unigram_matches, _ = self._clipped(self.unigrams, i, js)
+        bigram_matches, _ = self._clipped(self.bigrams, i, js)
+
+        hyp_len, ref_len = self.lengths[js], self.lengths[i]
+        p1 = unigram_matches / np.maximum(1, hyp_len)
+        p2 = np.where(bigram_matches > 0, bigram_matches / np.maximum(1, hyp_len - 1), sys.float_info.min)
+        bp = np.where(hyp_len > ref_len, 1.0, np.exp(1 - ref_len / np.maximum(1, hyp_len)))
+        bp = np.where(hyp_len == 0, 0.0, bp)
+        with np.errstate(divide="ignore"):
+            scores = bp * np.exp(0.5 * np.log(p1) + 0.5 * np.log(p2))
+        return np.where(unigram_matches > 0, scores, 0.0)
+
+
+class _Search:
+    """ Candidates and verified duplicate edges of single rows, shared with the pool workers """
+
+    def __init__(self, rows_txt, calls_num, window, bleu_thresh, method, lsh, bleu):
+        self.rows_txt = rows_txt
+        self.calls_num = np.asarray(calls_num)
+        self.window = window
+        self.bleu_thresh = bleu_thresh
+        self.token_sets = [set(tokens) for tokens in rows_txt]
+        self.pairs = None
+        if method == "lsh":
+            lsh = lsh or MinHashLSH()
+            pairs = lsh.candidate_pairs(self.token_sets, MIN_SHARED_TOKENS)
+            self.pairs = pairs[np.abs(self.calls_num[pairs[:, 0]] - self.calls_num[pairs[:, 1]]) <= MAX_CALLS_DIFF]
+            self.pair_starts = np.searchsorted(self.pairs[:, 0], np.arange(len(rows_txt) + 1))
+        self.scorer = Bleu2Scorer(rows_txt) if bleu == "batched" else None
+
+    def candidates(self, i):
+        if self.pairs is not None:
+            return self.pairs[self.pair_starts[i]:self.pair_starts[i + 1], 1]
+        return np.arange(i + 1, min(i + self.window, len(self.rows_txt)))
+
+    def edges(self, i):
+        """ Rows that row i marks as its duplicates """
+        js = self.candidates(i)
+        js = js[np.abs(self.calls_num[js] - self.calls_num[i]) <= MAX_CALLS_DIFF]
+        if self.scorer is not None:
+            js = js[self.scorer.shared_tokens(i, js) >= MIN_SHARED_TOKENS]
+            return js[self.scorer.score(i, js) >= self.bleu_thresh].tolist()
+
+        candidate_ids = [j for j in js if len(self.token_sets[i] & self.token_sets[j]) >= MIN_SHARED_TOKENS]
+        return [
+            int(j) for j in candidate_ids
+            if sentence_bleu([self.rows_txt[i]], self.rows_txt[j], weights=(0.5, 0.5)) >= self.bleu_thresh
+        ]
+
+
+_WORKER = {"search": None}
+
+
+def _init_worker(search):
+    _WORKER["search"] = search
+
+
+def _shard_edges(shard):
+    search = _WORKER["search"]
+    return [(i, edges) for i in range(*shard) for edges in [search.edges(i)] if edges]
+
+
+def find_duplicates(rows_txt, calls_num, window=3000, bleu_thresh=0.2, method="window", lsh=None, bleu="batched",
+                    workers=1, shard_size=256):
+    """
+    Indices of near-duplicate rows of a code-length-sorted table. Rows are visited in order, a row
+    not yet marked marks the later rows with calls_num within 3, at least 5 shared tokens and a BLEU-2 of
+    it against them of at least `bleu_thresh`. Candidates are the next `window` rows, or with
+    method="lsh" the `MinHashLSH` bucket mates in the whole table. BLEU is computed by `Bleu2Scorer`
+    for all candidates of a row at once, or pair by pair by NLTK with bleu="nltk".
+
+    With `workers` > 1 the edges of every row are computed in a pool, shards of `shard_size` consecutive
+    rows reading the rows of the window past their end, and resolved in order afterwards, so the result is
+    the same as the serial one.
+    """
+    n = len(rows_txt)
+    search = _Search(rows_txt, calls_num, window, bleu_thresh, method, lsh, bleu)
+    duplicates = set()
+
+    if workers > 1:
+        shards = [(start, min(start + shard_size, n)) for start in range(0, n, shard_size)]
+        edges = {}
+        with Pool(workers, initializer=_init_worker, initargs=(search,)) as pool:
+            for shard in tqdm(pool.imap_unordered(_shard_edges, shards), total=len(shards)):
+                edges.update(shard)
+        for i in range(n):
+            if i not in duplicates:
+                duplicates.update(edges.get(i, ()))
+        return duplicates
+
+    for i in tqdm(range(n), total=n):
+        if i not in duplicates:
+            duplicates.update(search.edges(i))
+    return duplicates
+
+
+def lsh_recall(rows_txt, calls_num, window=3000, bleu_thresh=0.2, lsh=None):
+    """ How many of the duplicates the windowed search finds the LSH search finds too """
+    window_duplicates = find_duplicates(rows_txt, calls_num, window, bleu_thresh, "window")
+    lsh_duplicates = find_duplicates(rows_txt, calls_num, window, bleu_thresh, "lsh", lsh)
+    found = len(window_duplicates & lsh_duplicates)
+    return {
+        "window_duplicates": len(window_duplicates),
+        "lsh_duplicates": len(lsh_duplicates),
+        "found": found,
+        "recall": found / len(window_duplicates) if window_duplicates else 1.0,
+        "lsh_only": len(lsh_duplicates - window_duplicates),
+    }
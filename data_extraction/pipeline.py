@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = "pipeline_state.json"
+REPORT_FILE = "pipeline_report.json"
+BUILD_CMD = "cmake -DCMAKE_EXPORT_COMPILE_COMMANDS=1 -DCMAKE_BUILD_TYPE=Debug .."
+
+
+class Stage:
+    """
+    A shell command run in `cwd` (relative to the project directory) after the stages in `deps`.
+    `inputs` are the paths whose contents decide whether the stage has to run again, `outputs` have to exist
+    for the stage to be skipped.
+    """
+
+    def __init__(self, name, command, deps=(), inputs=(), outputs=(), cwd="."):
+        self.name = name
+        self.command = command
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.cwd = cwd
+
+
+def fingerprint(path):
+    """
+    sha256 of a file, the HEAD commit of a git repository, the relative paths, sizes and mtimes of the files
+    of another directory, None if the path doesn't exist
+    """
+    if os.path.isdir(os.path.join(path, ".git")):
+        head = subprocess.run(["git", "-C", path, "rev-parse", "HEAD"], capture_output=True, text=True)
+        return "git:" + head.stdout.strip()
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file = os.path.join(root, name)
+                stat = os.stat(file)
+                digest.update(f"{os.path.relpath(file, path)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+        return "dir:" + digest.hexdigest()
+    if os.path.isfile(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    return None
+
+
+class Pipeline:
+    """
+    Runs stages as soon as their dependencies are done, independent ones concurrently. A stage is skipped
+    when its command and input fingerprints match the last successful run recorded in `pipeline_state.json`.
+    Wall times and statuses of the run are written to `pipeline_report.json`.
+    """
+
+    def __init__(self, stages, work_dir):
+        self.stages = {stage.name: stage for stage in stages}
+        self.work_dir = work_dir
+        self.state_path = os.path.join(work_dir, STATE_FILE)
+        self.state = {}
+        if os.path.isfile(self.state_path):
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+        self.report = {}
+        self.fingerprints = {}
+
+    def _path(self, path):
+        return os.path.join(self.work_dir, path)
+
+    def fingerprint(self, path):
+        # big inputs (the index database) are read by several stages, hash each version once
+        path = self._path(path)
+        stat = os.stat(path) if os.path.isfile(path) else None
+        key = (path, stat.st_mtime_ns, stat.st_size) if stat else None
+        if key is None:
+            return fingerprint(path)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = fingerprint(path)
+        return self.fingerprints[key]
+
+    def stage_key(self, stage):
+        inputs = {path: self.fingerprint(path) for path in stage.inputs}
+        key = json.dumps({"command": stage.command, "inputs": inputs}, sort_keys=True)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def is_cached(self, stage, key):
+        return self.state.get(stage.name, {}).get("key") == key and \
+            all(os.path.exists(self._path(path)) for path in stage.outputs)
+
+    def run_stage(self, name, force=False):
+        """ Runs the stage unless cached, returns its report entry and its key; `self.state` is left to the caller """
+        stage = self.stages[name]
+        key = self.stage_key(stage)
+        if not force and self.is_cached(stage, key):
+            print(f"[{name}] cached")
+            return {"status": "cached", "wall_time": 0.0}, key
+
+        print(f"[{name}] {stage.command}")
+        started = time.time()
+        returncode = subprocess.run(stage.command, shell=True, cwd=self._path(stage.cwd)).returncode
+        wall_time = time.time() - started
+        print(f"[{name}] {'done' if returncode == 0 else f'failed ({returncode})'} in {wall_time:.1f}s")
+
+        return {"status": "ran" if returncode == 0 else "failed", "wall_time": wall_time}, key
+
+    def run(self, force=(), workers=None):
+        pending = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(workers or len(self.stages)) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    statuses = [self.report.get(dep, {}).get("status") for dep in stage.deps]
+                    if any(s in ("failed", "skipped") for s in statuses):
+                        self.report[name] = {"status": "skipped", "wall_time": 0.0}
+                        del pending[name]
+                    elif all(s in ("ran", "cached") for s in statuses):
+                        running[executor.submit(self.run_stage, name, name in force)] = name
+                        del pending[name]
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    self.report[name], key = future.result()
+                    if self.report[name]["status"] == "ran":
+                        self.state[name] = {"key": key, "wall_time": self.report[name]["wall_time"]}
+                    elif self.report[name]["status"] == "failed":
+                        # outputs may be half written, the next run has to redo the stage
+                        self.state.pop(name, None)
+                self.save()
+
+        self.save()
+        return all(r["status"] in ("ran", "cached") for r in self.report.values())
+
+    def save(self):
+        with open(self.state_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+        with open(self._path(REPORT_FILE), "w") as f:
+            json.dump(self.report, f, indent=2)
+
+
+def _script(name, *args):
+    return " ".join([shlex.quote(sys.executable), shlex.quote(os.path.join(SCRIPTS_DIR, name))] +
+                    [shlex.quote(str(a)) for a in args])
+
+
+def pipeline_stages(project_name, project_git, codegraph_tool_path, work_dir, build_cmd=BUILD_CMD, build_dir=False,
+                    workers=8, function_dates=False):
+    """
+    The stages of pipeline.sh. Commit dates are blamed per line right after cloning, overlapping the build
+    and indexing, or with `function_dates` only for the table functions after db_stat.py.
+    """
+    folder = os.path.basename(project_git.rstrip("/"))
+    folder = folder[:-len(".git")] if folder.endswith(".git") else folder
+    cc_dir = os.path.join(folder, "build") if build_dir else folder
+    build = f"mkdir -p build && cd build && {build_cmd}" if build_dir else build_cmd
+
+    stages = [
+        Stage("clone", f"git clone --depth=1 {shlex.quote(project_git)} {shlex.quote(folder)}", outputs=[folder]),
+        Stage("cloc", f"cloc --json {shlex.quote(folder)} > cloc.json", ["clone"], [folder], ["cloc.json"]),
+        Stage("tool", f"cp {shlex.quote(os.path.abspath(codegraph_tool_path))} ./codegraph_tool && "
+                      f"./codegraph_tool --version", inputs=[os.path.abspath(codegraph_tool_path)],
+              outputs=["codegraph_tool"]),
+        Stage("build", build, ["clone"], [folder], [os.path.join(cc_dir, "compile_commands.json")], cwd=folder),
+        Stage("index", f"./codegraph_tool index --compile-commands-dir {shlex.quote(os.path.join(work_dir, cc_dir))} "
+                       f"--index-database-path codegraph_tool.db --ignore-diags=false --strip-unknown-options "
+                       f"--verbose --query-driver=false",
+              ["build", "tool"], [folder, os.path.join(cc_dir, "compile_commands.json"), "codegraph_tool"],
+              ["codegraph_tool.db"]),
+        Stage("export", f"./codegraph_tool query --index-database-path codegraph_tool.db --pretty-print "
+                        f"--arango-nodes=nodes --arango-edges=edges "
+                        f"< {shlex.quote(os.path.join(SCRIPTS_DIR, 'db_query.json'))} > out.json",
+              ["index"], ["codegraph_tool.db"], ["nodes.json", "edges.json"]),
+        Stage("db_stat", _script("db_stat.py", "--nodes-path", "nodes.json", "--edges-path", "edges.json",
+                                 "--project-path", work_dir, "--project-root", folder,
+                                 "--db-path", "codegraph_tool.db", "--out_path", "db_stat.csv", "--workers", workers),
+              ["export"], ["nodes.json", "edges.json", "codegraph_tool.db"],
+              ["db_stat.csv", "db_stat.csv.json", "db_stat.csv-prev.json"]),
+    ]
+
+    final = f"{project_name}_final.csv"
+    if function_dates:
+        stages += [
+            Stage("commit_dates", _script("commit_dates.py", folder, "function_dates.json",
+                                          "--table-path", "db_stat.csv", "--workers", workers),
+                  ["db_stat"], [folder, "db_stat.csv"], ["function_dates.json"]),
+            Stage("merge_commits", _script("merge_commits.py", "--table-path", "db_stat.csv",
+                                           "--function-dates-path", "function_dates.json", "--out-path", final),
+                  ["commit_dates"], ["db_stat.csv", "function_dates.json"], [final]),
+        ]
+    else:
+        stages += [
+            Stage("commit_dates", _script("commit_dates.py", folder, "commit_dates.ages", "--workers", workers),
+                  ["clone"], [folder], ["commit_dates.ages"]),
+            Stage("merge_commits", _script("merge_commits.py", "--table-path", "db_stat.csv",
+                                           "--commits-path", "commit_dates.ages", "--out-path", final),
+                  ["db_stat", "commit_dates"], ["db_stat.csv", "commit_dates.ages", "commit_dates.ages.index.json"],
+                  [final]),
+        ]
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codegraph_tool-path', dest="codegraph_tool_path", required=True)
+    parser.add_argument('--project-name', required=True)
+    parser.add_argument('--project-git', required=True)
+    parser.add_argument('--bear', action="store_true", help="build with `bear -- make`")
+    parser.add_argument('--build-dir', action="store_true")
+    parser.add_argument('--build-cmd', default=BUILD_CMD)
+    parser.add_argument('--workers', type=int, default=8, help="processes of db_stat.py and commit_dates.py")
+    parser.add_argument('--function-dates', action="store_true",
+                        help="blame only the table functions after db_stat.py instead of all lines during the build")
+    parser.add_argument('--force', nargs="*", default=[], help="stages to run even if their inputs are unchanged")
+
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.project_name)
+    os.makedirs(work_dir, exist_ok=True)
+    build_cmd = "bear -- make" if args.bear else args.build_cmd
+
+    stages = pipeline_stages(args.project_name, args.project_git, args.codegraph_tool_path, work_dir, build_cmd,
+                             args.build_dir, args.workers, args.function_dates)
+    pipeline = Pipeline(stages, work_dir)
+    ok = pipeline.run(force=set(args.force))
+
+    for name, result in pipeline.report.items():
+        print(f"{name:>14}: {result['status']:>7} {result['wall_time']:10.1f}s")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
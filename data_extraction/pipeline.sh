@@ -69,19 +69,6 @@ cp "$codegraph_tool_path" "./codegraph_tool"
 ./codegraph_tool --version
 
 
-# extract commit dates (in parallel)
-for number in 0 1 2 3 4 5 6 7
-do
-  python3 ../commit_dates.py "$folder" commit_dates.json 8 $number &
-done
-wait
-python3 ../commit_dates.py "$folder" commit_dates.json 8
-for number in 0 1 2 3 4 5 6 7
-do
-  rm "${number}_commit_dates.json"
-done
-
-
 cd "$folder" || exit
 
 # mkdir build if specified
@@ -100,7 +87,10 @@ cd "$project_path" || exit
 ./codegraph_tool query --index-database-path codegraph_tool.db --pretty-print --arango-nodes=nodes --arango-edges=edges < ../db_query.json > out.json
 
 # collect statistics into a table
-python3 ../db_stat.py --nodes-path nodes.json --project-path "$project_path" --project-root "$folder" --db-path "codegraph_tool.db" --out_path "db_stat.csv"
+python3 ../db_stat.py --nodes-path nodes.json --edges-path edges.json --project-path "$project_path" --project-root "$folder" --db-path "codegraph_tool.db" --out_path "db_stat.csv" --workers 8
+
+# extract commit dates of the table functions (blames only their line ranges)
+python3 ../commit_dates.py "$folder" function_dates.json --table-path "db_stat.csv" --workers 8
 
 # merge commit dates into table
-python3 ../merge_commits.py --table-path "db_stat.csv" --db-path "codegraph_tool.db" --commits-path "commit_dates.json" --out-path "${project_name}_final.csv"
+python3 ../merge_commits.py --table-path "db_stat.csv" --function-dates-path "function_dates.json" --out-path "${project_name}_final.csv"
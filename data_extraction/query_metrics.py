@@ -0,0 +1,135 @@
+import bisect
+import json
+import threading
+import time
+
+
+# log-spaced latency buckets from 0.1 ms to 1000 s, ten per decade
+BUCKET_BOUNDS = [1e-4 * 10 ** (i / 10) for i in range(71)]
+PERCENTILES = [50, 95, 99]
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile, exact up to the bucket width (~26%) """
+        count = self.count
+        if count == 0:
+            return None
+        rank = p / 100 * count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return min(BUCKET_BOUNDS[i], self.max) if i < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {"counts": list(self.counts), "total": self.total, "max": self.max}
+
+    def merge(self, snapshot):
+        self.counts = [a + b for a, b in zip(self.counts, snapshot["counts"])]
+        self.total += snapshot["total"]
+        self.max = max(self.max, snapshot["max"])
+
+    def report(self):
+        count = self.count
+        result = {"count": count, "mean": self.total / count if count else None, "max": self.max}
+        result.update({f"p{p}": self.percentile(p) for p in PERCENTILES})
+        return result
+
+
+class QueryMetrics:
+    """
+    Latency histograms and failure counters of codegraph_tool queries split by query kind
+    (goto, callgraph), plus the number of processed functions for the throughput.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.last_write = self.started
+        # batches of one session are answered from several threads
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.latency = {}
+        self.counters = {}
+        self.functions = 0
+
+    def _count(self, kind, counter, n=1):
+        with self.lock:
+            counters = self.counters.setdefault(kind, {"timeouts": 0, "decode_errors": 0, "errors": 0})
+            counters[counter] += n
+
+    def record(self, kind, seconds):
+        with self.lock:
+            self.latency.setdefault(kind, LatencyHistogram()).add(seconds)
+
+    def timeout(self, kind):
+        self._count(kind, "timeouts")
+
+    def decode_error(self, kind):
+        self._count(kind, "decode_errors")
+
+    def error(self, kind):
+        self._count(kind, "errors")
+
+    def function_done(self, n=1):
+        self.functions += n
+
+    def snapshot(self):
+        return {
+            "latency": {k: h.snapshot() for k, h in self.latency.items()},
+            "counters": {k: dict(c) for k, c in self.counters.items()},
+            "functions": self.functions,
+        }
+
+    def merge(self, snapshot):
+        for kind, histogram in snapshot["latency"].items():
+            self.latency.setdefault(kind, LatencyHistogram()).merge(histogram)
+        for kind, counters in snapshot["counters"].items():
+            for counter, n in counters.items():
+                self._count(kind, counter, n)
+        self.functions += snapshot["functions"]
+
+    def report(self):
+        elapsed = time.time() - self.started
+        kinds = sorted(set(self.latency) | set(self.counters))
+        return {
+            "elapsed": elapsed,
+            "functions": self.functions,
+            "functions_per_second": self.functions / elapsed if elapsed > 0 else None,
+            "queries": {
+                kind: dict(
+                    self.latency[kind].report() if kind in self.latency else LatencyHistogram().report(),
+                    **self.counters.get(kind, {"timeouts": 0, "decode_errors": 0, "errors": 0})
+                )
+                for kind in kinds
+            },
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        self.last_write = time.time()
+
+    def write_every(self, path, period):
+        if time.time() - self.last_write >= period:
+            self.write(path)
+
+
+METRICS = QueryMetrics()
@@ -0,0 +1,73 @@
+import io
+import mmap
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SourceFile:
+    """
+    Memory-mapped source file with the offsets of its lines. Indexing and slicing give lines the way
+    `open(path, encoding="utf-8").readlines()` does, only the requested lines are decoded.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) else b""
+        self.lines = None
+        raw = np.frombuffer(self.data, dtype=np.uint8) if len(self.data) else np.zeros(0, dtype=np.uint8)
+
+        cr = np.flatnonzero(raw == ord("\r"))
+        crlf = cr[(cr + 1 < len(raw)) & (raw[np.minimum(cr + 1, len(raw) - 1)] == ord("\n"))]
+        if len(crlf) != len(cr):
+            # old mac line ends split lines in text mode, such files are rare enough to decode whole
+            self.lines = io.TextIOWrapper(io.BytesIO(self.data[:]), encoding="utf-8").readlines()
+            return
+
+        self.crlf = len(crlf) > 0
+        ends = np.flatnonzero(raw == ord("\n")) + 1
+        if len(raw) and (not len(ends) or ends[-1] != len(raw)):
+            ends = np.append(ends, len(raw))
+        self.offsets = np.concatenate([[0], ends]).astype(np.int64)
+
+    def __len__(self):
+        return len(self.lines) if self.lines is not None else len(self.offsets) - 1
+
+    def _line(self, i):
+        line = self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+        return line.replace("\r\n", "\n") if self.crlf else line
+
+    def __getitem__(self, i):
+        if self.lines is not None:
+            return self.lines[i]
+        if isinstance(i, slice):
+            return [self._line(j) for j in range(len(self))[i]]
+        return self._line(range(len(self))[i])
+
+
+class SourceStore:
+    """ LRU of the last `max_files` opened `SourceFile`s, so repeated slices of a file cost no file I/O """
+
+    def __init__(self, max_files=256):
+        self.max_files = max_files
+        self.files = OrderedDict()
+
+    def get(self, path):
+        if path in self.files:
+            self.files.move_to_end(path)
+            return self.files[path]
+
+        source = SourceFile(path)
+        self.files[path] = source
+        if len(self.files) > self.max_files:
+            # unmapped once the last reference to the evicted file is gone
+            self.files.popitem(last=False)
+        return source
+
+
+SOURCES = SourceStore()
+
+
+def source_lines(path):
+    """ Lines of the file at `path` as a list-like `SourceFile` from the shared store """
+    return SOURCES.get(path)
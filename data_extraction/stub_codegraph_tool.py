@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+A stand-in for `codegraph_tool query` to exercise the extraction scripts without the real indexer.
+
+The index database is a json file:
+    {"functions": {id: {"id", "name", "pos": {"path", "line", "col"}, "end": {"line", "col"}, "system", "doc"}},
+     "calls": {caller_id: [callee_id, ...]}}
+A function record may hold a "delay" in seconds to make its callgraph query slow.
+
+Queries are read from stdin one json value after another and every answer is printed on its own line,
+so a single process can serve a whole `QuerySession`. `--one-shot` answers the first query only,
+like a tool that has to be restarted for every query. `--arango-nodes=nodes --arango-edges=edges`
+writes the whole graph to nodes.json and edges.json instead of answering queries.
+
+    ./stub_codegraph_tool.py query --index-database-path stub_db.json < query.json
+    python3 db_stat.py --codegraph-tool ./stub_codegraph_tool.py --db-path stub_db.json ...
+"""
+import argparse
+import json
+import sys
+import time
+
+
+def goto(db, query):
+    func = db["functions"].get(query["id"])
+    return [func] if func else []
+
+
+def callgraph(db, query):
+    func = db["functions"].get(query["function"])
+    if func is None:
+        return []
+
+    time.sleep(func.get("delay", 0))
+    callers = [caller for caller, callees in db["calls"].items() if query["function"] in callees]
+    result = {k: func[k] for k in ("id", "name", "pos", "doc") if k in func}
+    result["next"] = [{"id": callee} for callee in db["calls"].get(query["function"], [])]
+    result["prev"] = [{"id": caller} for caller in callers]
+    return [result]
+
+
+QUERIES = {
+    "goto": goto,
+    "callgraph": callgraph,
+}
+
+
+def export_arango(db, nodes_name, edges_name):
+    with open(f"{nodes_name}.json", "w") as f:
+        json.dump([dict(func, _key=func_id) for func_id, func in db["functions"].items()], f)
+    with open(f"{edges_name}.json", "w") as f:
+        json.dump([
+            {"_from": f"{nodes_name}/{caller}", "_to": f"{nodes_name}/{callee}"}
+            for caller, callees in db["calls"].items() for callee in callees
+        ], f)
+
+
+def read_queries(stream):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    for line in stream:
+        buffer += line
+        while buffer.strip():
+            try:
+                query, end = decoder.raw_decode(buffer.lstrip())
+            except ValueError:
+                break
+            buffer = buffer.lstrip()[end:]
+            yield query
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=["query"])
+    parser.add_argument('--index-database-path')
+    parser.add_argument('--pretty-print', action="store_true")
+    parser.add_argument('--one-shot', action="store_true")
+    parser.add_argument('--arango-nodes')
+    parser.add_argument('--arango-edges')
+
+    args = parser.parse_args()
+
+    with open(args.index_database_path, "r") as f:
+        db = json.load(f)
+
+    if args.arango_nodes and args.arango_edges:
+        export_arango(db, args.arango_nodes, args.arango_edges)
+        return
+
+    for query in read_queries(sys.stdin):
+        answer = QUERIES[query["query"]](db, query)
+        print(json.dumps(answer, indent=2 if args.pretty_print else None), flush=True)
+        if args.one_shot:
+            break
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class FilterEngine:
+    """
+    Filters of a table run cheapest first. Filters read derived columns through `get`, a column is
+    computed once, vectorized over the rows left when it is first needed, and cached for the later filters.
+    """
+
+    def __init__(self, df):
+        self.df = df.reset_index(drop=True)
+        self.columns = {}
+        self.cache = {}
+        self.filters = []
+
+    def column(self, name, fn):
+        """ `fn(engine, df)` gives the values of column `name` for the rows of `df` """
+        self.columns[name] = fn
+        return self
+
+    def add_filter(self, name, fn, cost=0, table=False):
+        """
+        `fn(engine)` gives a boolean mask over `engine.df`, or with `table` the filtered table itself.
+        Filters run in order of `cost`, ties in the order they were added.
+        """
+        self.filters.append((cost, len(self.filters), name, fn, table))
+        return self
+
+    def get(self, name):
+        """ Values of the derived column `name` for the rows of `self.df` """
+        cached = self.cache.get(name)
+        missing = self.df.index if cached is None else self.df.index.difference(cached.index)
+        if len(missing):
+            values = pd.Series(list(self.columns[name](self, self.df.loc[missing])), index=missing)
+            cached = values if cached is None else pd.concat([cached, values])
+            self.cache[name] = cached
+        return cached.loc[self.df.index]
+
+    def run(self, report=None):
+        """ Applies the filters, `report(before, after, name, seconds)` after each, returns the table left """
+        for _, _, name, fn, table in sorted(self.filters, key=lambda f: f[:2]):
+            before = len(self.df)
+            start = time.perf_counter()
+            if table:
+                # the new rows share no index with the old ones, derived columns start over
+                self.df = fn(self)
+                self.cache = {}
+            else:
+                self.df = self.df[np.asarray(fn(self), dtype=bool)]
+            if report is not None:
+                report(before, len(self.df), name, time.perf_counter() - start)
+        return self.df
@@ -0,0 +1,119 @@
+import csv
+import json
+
+
+TABLE_COLUMNS = [
+    "name", "path", "doc", "calls_num", "dep_num",
+    "same_file", "same_package", "project", "stdlib", "external_binaries", "code_length", "pos", "end",
+]
+GRAPH_SUFFIXES = {"next": "", "prev": "-prev"}
+
+
+def get_edges(funcs):
+    return [
+        {
+            "id": func[0],
+            "name": func[1],
+            "path": func[2],
+            "start": func[4],
+            "end": func[5],
+        }
+        for func in funcs
+    ]
+
+
+class _CsvTable:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file, lineterminator="\n")
+        self.writer.writerow([""] + TABLE_COLUMNS)
+
+    def write(self, func_id, data):
+        self.writer.writerow([func_id] + [data[c] for c in TABLE_COLUMNS])
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetTable:
+    def __init__(self, path, row_group_size=10000):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema(
+            [("id", pa.string()), ("name", pa.string()), ("path", pa.string()), ("doc", pa.string())] +
+            [(c, pa.int64()) for c in TABLE_COLUMNS[3:]]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self.rows = []
+
+    def write(self, func_id, data):
+        self.rows.append(dict(data, id=func_id))
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            columns = {c: [row[c] for row in self.rows] for c in self.schema.names}
+            self.writer.write_table(self.pa.table(columns, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class _GraphJson:
+    """ {func id: [edge, ...]} written entry by entry, or one `{"id", "edges"}` line per function for jsonl """
+
+    def __init__(self, path, jsonl=False):
+        self.file = open(path, "w", encoding="utf-8")
+        self.jsonl = jsonl
+        self.empty = True
+        if not jsonl:
+            self.file.write("{")
+
+    def write(self, func_id, edges):
+        if self.jsonl:
+            self.file.write(json.dumps({"id": func_id, "edges": edges}) + "\n")
+        else:
+            self.file.write(("" if self.empty else ", ") + f"{json.dumps(func_id)}: {json.dumps(edges)}")
+        self.empty = False
+
+    def close(self):
+        if not self.jsonl:
+            self.file.write("}")
+        self.file.close()
+
+
+class DatasetWriter:
+    """
+    Writes db_stat.py outputs incrementally while functions are processed: the table (csv, or parquet
+    row groups for a `.parquet` path) and the `next`/`prev` graphs (`{path}.json`, `{path}-prev.json`
+    or the same names with `.jsonl`).
+    """
+
+    def __init__(self, out_path, graph_format="json"):
+        self.table = _ParquetTable(out_path) if out_path.endswith(".parquet") else _CsvTable(out_path)
+        self.graphs = {
+            d: _GraphJson(f"{out_path}{suffix}.{graph_format}", jsonl=graph_format == "jsonl")
+            for d, suffix in GRAPH_SUFFIXES.items()
+        }
+
+    def write(self, func_id, data):
+        self.table.write(func_id, data)
+        for d, graph in self.graphs.items():
+            graph.write(func_id, get_edges(data[f"{d}_funcs"]))
+
+    def close(self):
+        self.table.close()
+        for graph in self.graphs.values():
+            graph.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
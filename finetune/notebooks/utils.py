@@ -1,11 +1,18 @@
 import json
 import os
 import re
+import sys
 
 import pandas as pd
 
 
 REPOS_PATH = "/repos"
+DATA_EXTRACTION_PATH = "/data_extraction"
+
+if DATA_EXTRACTION_PATH not in sys.path:
+    sys.path.append(DATA_EXTRACTION_PATH)
+import callgraph_store
+from source_store import source_lines
 
 
 def read_json(path):
@@ -15,12 +22,19 @@ def read_json(path):
     return {}
 
 
+def read_call_graph(path):
+    """ Reads a next json, or the memory-mapped store next to it (`{name}.graph`, see callgraph_store.py) """
+    try:
+        return callgraph_store.read_call_graph(path)
+    except FileNotFoundError:
+        return {}
+
+
 def extract_fn(path, start, length):
     if not os.path.isfile(f"{REPOS_PATH}/{path}"):
         return None
 
-    with open(f"{REPOS_PATH}/{path}", encoding="utf-8") as f:
-        lines = f.readlines()
+    lines = source_lines(f"{REPOS_PATH}/{path}")
 
     if start + length + 1 < len(lines) and lines[start + length].strip() != "}" and lines[start + length + 1].strip() == "}" and "}" not in lines[start + length]:
         start += 1
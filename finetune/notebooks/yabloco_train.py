@@ -90,7 +90,7 @@ sys.path.append("./scripts")
 from lora import LORA
 from dora import BNBDORA, HQQDORA, DORALayer, MagnitudeLayer
 from batch_generator import get_all_df_filtered, get_context, GET_SIZE
-from utils import read_json, extract_fn, extract_signature
+from utils import read_json, read_call_graph, extract_fn, extract_signature
 
 class Logger:
     def __init__(self, args, log_to="stdout", project_name="fsdp_qlora", entity=None, group=None, name=None, rank=0):
@@ -293,7 +293,7 @@ class InstructionDataset(Dataset):
         if self.style == "yabloco_curriculum" and not val:
             print(f"EPOCHS: {EPOCHS}")
 
-            next_json = read_json(f"/train_data/train_functions/{self.repo}.json")
+            next_json = read_call_graph(f"/train_data/train_functions/{self.repo}.json")
             all_df = get_all_df_filtered(self.repo, next_json)
             all_df_ids = {row.id for _, row in all_df.iterrows() if row.code is not None}
 
@@ -2,6 +2,7 @@ import json
 import os
 import time
 from collections import defaultdict
+from collections.abc import Mapping
 from functools import lru_cache
 
 import pandas as pd
@@ -16,6 +17,37 @@ def read_json(path):
     return {}
 
 
+class BenchJson(Mapping):
+    """
+    Benchmark json by function id. Calls of jsons written with code blobs keep a "code_ref" into the
+    "blobs" table instead of the callee code, the code is put back into the calls of a function when it is read.
+    """
+
+    def __init__(self, data):
+        self.blobs = data.pop("blobs", {})
+        self.data = data
+        self.resolved = {}
+
+    def __getitem__(self, fn):
+        if fn not in self.resolved:
+            entry = self.data[fn]
+            if self.blobs and "calls" in entry:
+                calls = [dict(c, code=self.blobs[c["code_ref"]]) if "code_ref" in c else c for c in entry["calls"]]
+                entry = dict(entry, calls=calls)
+            self.resolved[fn] = entry
+        return self.resolved[fn]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+def read_bench_json(path):
+    return BenchJson(read_json(path))
+
+
 def get_result_from_disk(bench, model, repo, fn, gen_i=None):
     c = f"{fn}-{gen_i}" if gen_i is not None else fn
     return read_fn_results(c, f"{RESULTS_PATH}/{bench}/{model}/{repo}/")
@@ -83,7 +115,7 @@ def read_bench_df():
         for v in versions
     }
     bench_js = {
-        v: read_json(f"{BENCH_JS_PATH}/{v}.json")
+        v: read_bench_json(f"{BENCH_JS_PATH}/{v}.json")
         for v in versions
     }
     df = {
@@ -1,14 +1,19 @@
-import json
+import os
 import re
+import sys
 
 import pandas as pd
-from nltk.translate.bleu_score import sentence_bleu
 from pandas import DataFrame
-from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_extraction"))
+from callgraph_store import read_call_graph
+from near_duplicates import find_duplicates, lsh_recall
+from source_store import source_lines
 
 VERSION = "bench-v0.6"
 REPOSITORIES = ["bullet3", "openssl", "redis", "llvm"]
 EDGES = ["stdlib", "same_file", "same_package", "project"]
+DUPLICATE_WORKERS = os.cpu_count() or 1
 
 
 def has_docstring(f, length=3):
@@ -43,8 +48,7 @@ def has_few_calls(f, max_num_calls=10):
 
 
 def extract_fn(path, start, length):
-    with open(f"../pipeline/repos/{path}", encoding="utf-8") as f:
-        lines = f.readlines()
+    lines = source_lines(f"../pipeline/repos/{path}")
     code = lines[start:start + length + 1]
     result = "".join(code)
     if "#if" in result and "#else" in result:
@@ -77,7 +81,10 @@ def extract_code(df):
     return code
 
 
-def filter_duplicates_weak(df: DataFrame, window=3000, bleu_thresh=0.2):
+def filter_duplicates_weak(df: DataFrame, window=3000, bleu_thresh=0.2, method="window", check_recall=False,
+                           workers=DUPLICATE_WORKERS):
+    # method="lsh" searches the whole table through a MinHash LSH index instead of the length window,
+    # workers > 1 computes the duplicates of row shards in a pool, the result is the same as with one
     df = df.sort_values(by="code_length")
     rows_txt = df.apply(lambda x: f"{x['fname']} {x['doc']}", axis=1).values
     code = extract_code(df)
@@ -87,22 +94,9 @@ def filter_duplicates_weak(df: DataFrame, window=3000, bleu_thresh=0.2):
     calls_num = df.calls_num.values
 
     df = df.reset_index(drop=True)
-    duplicates = set()
-    for i, row in tqdm(df.iterrows(), total=len(df)):
-        if not isinstance(i, int):
-            print("warning: df index type")
-            continue
-
-        if i in duplicates:
-            continue
-
-        candidate_ids = [
-            j for j in range(i + 1, i + window)
-            if j < len(rows_txt) and abs(calls_num[i] - calls_num[j]) <= 3 and len(set(rows_txt[i]) & set(rows_txt[j])) >= 5
-        ]
-        for j in candidate_ids:
-            if sentence_bleu([rows_txt[i]], rows_txt[j], weights=(0.5, 0.5)) >= bleu_thresh:
-                duplicates.add(j)
+    duplicates = find_duplicates(rows_txt, calls_num, window, bleu_thresh, method, workers=workers)
+    if check_recall:
+        print("LSH recall:", lsh_recall(rows_txt, calls_num, window, bleu_thresh))
 
     df = df[~df.index.isin(duplicates)]
     df = df.reset_index(drop=True)
@@ -130,8 +124,7 @@ def get_all(repo):
 
 
 def get_prev(repo, ids):
-    with open(f"prev/{repo}-prev.json") as f:
-        prev = json.load(f)
+    prev = read_call_graph(f"prev/{repo}-prev.json", direction="prev")
 
     result = []
     for i in ids: